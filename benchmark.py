@@ -0,0 +1,242 @@
+"""
+Benchmarks of the capture, detection, upload and logging hot paths on
+synthetic 960x540 frames, runnable on any Linux box.
+
+    python3 benchmark.py [--repeat 50] [--only motion] [--output bench_output.json]
+
+Every stage reports calls, frames per second, latency percentiles in ms and
+the peak of memory traced by tracemalloc during one extra call. Results are
+written as JSON so runs can be compared before flashing devices.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import time
+import tracemalloc
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from offline import enter_workdir, setup_environment, trap_me
+
+setup_environment('benchmark')
+OUTPUT_CWD = enter_workdir('bench')
+
+from capture import Capture  # noqa: E402
+from grabber import FrameGrabber  # noqa: E402
+from upload import UploadManager  # noqa: E402
+from utils import Constants, FooterRenderer, HistogramMatcher, ImageOperations, current_milli_time  # noqa: E402
+from data_link_layer import SQLite  # noqa: E402
+
+WIDTH, HEIGHT = 960, 540
+
+ME = trap_me(description='Benchmark Trap', rest_interval=0, sunrise='2020-01-01T00:00:00',
+             sunset='2020-01-01T23:59:59', frames_per_sec=1, should_log=True)
+
+
+def synthetic_frames(count, seed=0):
+    """
+    A textured background with noise and a bright square moving across it.
+    """
+    rng = np.random.default_rng(seed)
+    background = cv2.GaussianBlur(rng.integers(0, 256, (HEIGHT, WIDTH, 3), dtype=np.uint8), (21, 21), 0)
+    frames = []
+    for i in range(count):
+        frame = cv2.add(background, rng.integers(0, 8, background.shape, dtype=np.uint8))
+        x = 40 + (i * 60) % (WIDTH - 160)
+        cv2.rectangle(frame, (x, 200), (x + 80, 280), (230, 230, 230), -1)
+        frames.append(frame)
+    return frames
+
+
+def stage(fn, repeat, frames_per_call=1):
+    latencies = []
+    fn()  # warm up caches, lazily built layouts and lookups
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies = np.array(latencies) * 1000
+    return {
+        'calls': repeat,
+        'fps': round(frames_per_call * repeat / (latencies.sum() / 1000), 2),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+        'p95_ms': round(float(np.percentile(latencies, 95)), 3),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+        'max_ms': round(float(latencies.max()), 3),
+        'peak_traced_kb': round(peak / 1024, 1),
+    }
+
+
+def bench_histograms(repeat):
+    a, b = [ImageOperations.convert_image_to_gray(f) for f in synthetic_frames(2)]
+    matcher = HistogramMatcher(a)
+    return {
+        'match_histograms': stage(lambda: ImageOperations.match_histograms(b, a), repeat),
+        'error_image_gray_histmatch': stage(lambda: ImageOperations.error_image_gray_histmatch(a, b), repeat),
+        'error_image_gray_histmatch_reused': stage(
+            lambda: ImageOperations.error_image_gray_histmatch(a, b, matcher=matcher), repeat),
+    }
+
+
+def bench_motion(capture, repeat):
+    results = {}
+    frames = [(str(i) + '.jpg', f) for i, f in enumerate(synthetic_frames(ME['motion_interval']))]
+    for detector in ('first_frame', 'running_average', 'mog'):
+        for scale in (1.0, 0.5):
+            capture.config.detector_type = detector
+            capture.config.pyramid_scale = scale
+            capture.setup_detector()
+            results[f'motion_detection_{detector}_x{scale}'] = stage(
+                lambda: capture.motion_detection(frames), repeat, frames_per_call=len(frames))
+    return results
+
+
+def bench_footer(repeat):
+    image = cv2.resize(synthetic_frames(1)[0], (640, 480))
+    file_dt = datetime.now()
+    name = ME['description']
+    renderer = FooterRenderer()
+    (short_txt, _), (long_txt, _) = renderer.texts(file_dt, name)
+    return {
+        'addFooter': stage(lambda: ImageOperations.addFooter(image.copy(), short_txt, long_txt), repeat),
+        'footer_renderer': stage(lambda: renderer.draw(image.copy(), file_dt, name), repeat),
+    }
+
+
+def bench_prepare_image(uploader, repeat):
+    event = 'bench_prepare'
+    item = str(current_milli_time()) + '.jpg'
+    os.makedirs(os.path.join(uploader.events_dir, event), exist_ok=True)
+    cv2.imwrite(os.path.join(uploader.events_dir, event, item), synthetic_frames(1)[0])
+    return {'prepare_image': stage(lambda: uploader.prepare_image(event, item, width=640, height=480), repeat)}
+
+
+def bench_write_event(capture, repeat):
+    frames = synthetic_frames(ME['motion_interval'])
+
+    def write_event():
+        capture.event_id = 'bench_' + str(current_milli_time())
+        now = current_milli_time()
+        capture.write_event([(str(now + i) + '.jpg', frame) for i, frame in enumerate(frames)])
+        capture.writer.flush()
+
+    results = {}
+    for event_format in ('jpeg', 'container'):
+        capture.writer.container = event_format == 'container'
+        results[f'write_event_{event_format}'] = stage(write_event, repeat, frames_per_call=len(frames))
+    capture.writer.container = False
+    return results
+
+
+def log_worker(mode, count, latencies):
+    if mode == 'put_log':
+        constants = Constants()
+        constants.read_params()
+        constants.table = 'capture_logs'
+        for i in range(count):
+            start = time.perf_counter()
+            constants.put_log('BENCHMARK', f'row {i} from {os.getpid()}')
+            latencies.append(time.perf_counter() - start)
+        constants.log_writer.flush()
+    else:
+        db = SQLite('local.db', 5)
+        for i in range(count):
+            start = time.perf_counter()
+            with db:
+                db.data_entry('capture_logs', (datetime.now().strftime('%Y-%m-%dT%H:%M:%S'), 'BENCHMARK', 1,
+                                               f'row {i} from {os.getpid()}'))
+            latencies.append(time.perf_counter() - start)
+
+
+def bench_logging(repeat):
+    """
+    Two processes writing log rows at once, like capture and upload do.
+    """
+    results = {}
+    count = repeat * 20
+    for mode in ('put_log', 'data_entry'):
+        with multiprocessing.Manager() as manager:
+            latencies = manager.list()
+            workers = [multiprocessing.Process(target=log_worker, args=(mode, count, latencies)) for _ in range(2)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            latencies = np.array(list(latencies)) * 1000
+
+        results[f'{mode}_2_processes'] = {
+            'calls': len(latencies),
+            'rows_per_sec': round(len(latencies) / elapsed, 2),
+            'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+            'p95_ms': round(float(np.percentile(latencies, 95)), 3),
+            'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+            'max_ms': round(float(latencies.max()), 3),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the camera trap hot paths')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--only', help='only run suites whose name contains this')
+    parser.add_argument('--output', default='bench_output.json')
+    args = parser.parse_args()
+
+    os.makedirs(Constants.data_dir, exist_ok=True)
+    Constants().write_params(ME)
+    capture = Capture()
+    capture.grabber = FrameGrabber(None)  # never opened, only its empty ring is used for the pre-roll
+    uploader = UploadManager()
+
+    suites = {
+        'histograms': lambda: bench_histograms(args.repeat),
+        'motion': lambda: bench_motion(capture, args.repeat),
+        'footer': lambda: bench_footer(args.repeat),
+        'prepare_image': lambda: bench_prepare_image(uploader, args.repeat),
+        'write_event': lambda: bench_write_event(capture, args.repeat),
+        'logging': lambda: bench_logging(args.repeat),
+    }
+
+    results = {}
+    for name, suite in suites.items():
+        if args.only and args.only not in name:
+            continue
+        logging.warning(f'Running {name}')
+        results.update(suite())
+
+    report = {
+        'created': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': platform.machine(),
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'frame': [WIDTH, HEIGHT],
+        'repeat': args.repeat,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'results': results,
+    }
+    output = os.path.join(OUTPUT_CWD, args.output)
+    with open(output, 'w') as file:
+        file.write(json.dumps(report, indent=4))
+
+    for name, result in results.items():
+        print(f'{name:45} ' + ' '.join(f'{k}={v}' for k, v in result.items()))
+    print(f'Written to {output}')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - benchmark:%(levelname)s - %(message)s', level=logging.WARNING)
+    main()
@@ -1,20 +1,31 @@
 import logging
-import os
+import threading
 import time
-from datetime import datetime
 from uuid import uuid4
 import requests
 
-import Jetson.GPIO as GPIO
 import cv2
 
-from utils import gstreamer_pipeline, current_milli_time, Constants, ImageOperations
+from grabber import FrameGrabber
+from hardware import Hardware
+from storage import StorageManager
+from utils import gstreamer_pipeline, Constants, ImageOperations, WorkSignal, DETECTORS, \
+    create_detector, AdaptiveThreshold, DuplicateFilter
+from writer import EventWriter
 
 
 class Capture(Constants):
     event_id = None
     table = 'capture_logs'
+    metrics_name = 'capture'
     mask = None
+    motion_detector = None
+    sunlight = None
+    recording_until = 0
+    event_created = None
+    pir_until = 0
+    storage_state = 'ok'
+    streamed = 0
 
     def __init__(self):
         super().__init__()
@@ -22,99 +33,228 @@ class Capture(Constants):
         self.read_params()
         self.download_roi_mask()
         self.read_roi_mask()
+        self.setup_detector()
+        self.baseline = AdaptiveThreshold()
+        self.duplicates = DuplicateFilter()
 
         with self.db:
             self.db.create_tables()
 
         logging.info(f'Checked Tables')
 
-        self.put_log(
-            [f'"{datetime.now().strftime("%Y-%m-%dT%H:%M:%S")}"', '"SCRIPT_STARTED"', '1', f'"Capture Started"'])
+        self.upload_signal = WorkSignal(self.upload_fifo)
+        self.writer = EventWriter(self.events_dir, self.temp_dir, workers=self.writer_workers,
+                                  container=self.event_format == 'container', on_saved=self.enqueue_upload,
+                                  on_error=self.write_failed, metrics=self.metrics)
+        self.storage = StorageManager(self.events_dir, self.done_dir, self.temp_dir)
+        self.check_storage()
+        self.scheduler.every(self.storage_interval, self.check_storage)
+        self.put_log('SCRIPT_STARTED', 'Capture Started')
         self.setup_sensors()
+        self.pir_signal = threading.Event()
+        self.hardware.watch_motion(self.pir_triggered)
+        self.scheduler.every(lambda: self.update_after, self.heartbeat)
+
+    def heartbeat(self):
+        self.put_log('ALIVE', 'Capture Alive')
 
     def run(self):
         while True:
-            if self.params_expired:
-                self.read_params()
-                if self.logging:
-                    self.put_log([f'"{datetime.now().strftime("%Y-%m-%dT%H:%M:%S")}"',
-                                  '"ALIVE"', '1', f'"Capture Alive"'])
-                    self.logging = False
+            self.scheduler.run_pending()
+            self.step()
+
+    def step(self):
+        """
+        One cycle of the capture loop: a motion window, and the event it
+        starts or extends, or an idle wait.
+        :return: (is_motion, contours) of the window, None if it idled instead
+        """
+        if self.clock.millis() > self.recording_until:
+            self.log_duplicates()
+
+        if not self.live:
+            # Nothing to do until the next param refresh
+            self.idle()
+            return None
+
+        self.pir_signal.clear()
+        if self.pir_gated() and not self.awake():
+            # Camera and IR stay idle until a PIR sensor fires
+            self.infrared_switch(on=False)
+            self.grabber.pause()
+            self.idle(self.pir_signal)
+            return None
+
+        self.grabber.resume()
+        self.setup_detector()
+        pir = sum(self.hardware.read_motion())
+
+        sunlight = self.is_sunlight()
+        if sunlight != self.sunlight:
+            # IR illumination changes the whole scene, learn the background again
+            self.motion_detector.reset()
+            self.sunlight = sunlight
+
+        self.night_vision(on=not sunlight)
+        self.infrared_switch(on=not sunlight)
+        logging.info('Polling for Motion')
+        frames = self.capture(self.motion_interval)
+        is_motion, contours = self.motion_detection(frames)
+
+        if is_motion:
+            first_timestamp, last_timestamp = int(frames[0][0][:-4]), int(frames[-1][0][:-4])
+            if first_timestamp <= self.recording_until:
+                # Still recording the previous event, extend it with the frames not streamed yet
+                logging.debug(f'Motion continues, extending event {self.event_id}')
+                self.stream([f for f in frames if int(f[0][:-4]) > self.recording_until])
+            elif self.storage_state == 'stop':
+                logging.warning('Motion Detected but storage is full, event not captured')
+                self.metrics.count('events_dropped')
+                return is_motion, contours
             else:
-                self.logging = True
-
-            if not self.live:
-                continue
-
-            self.event_id = uuid4().hex
-            pir1, pir2 = GPIO.input(self.motion1), GPIO.input(self.motion2)
+                logging.debug(f'Motion Detected and Capturing Started')
+                # The previous recording may have ended within this window
+                self.log_duplicates()
+                self.event_id = uuid4().hex
+                self.writer.container = self.event_format == 'container'
+                with self.metrics.timer('event_write_ms'):
+                    self.write_event(frames)
+                self.metrics.count('events')
+                self.put_log('EVENT_CAPTURED', f'UUID: {self.event_id}, Contours: {contours}, PIR: {pir}')
+            logging.debug(f'Event captured with contours {contours}')
+            # The next video_interval seconds are streamed by capture() while polling goes on
+            self.recording_until = last_timestamp + self.video_interval * 1000
+        elif not self.is_sunlight() and self.clock.millis() > self.recording_until:
+            self.infrared_switch(on=False)
+            self.idle(timeout=self.rest_interval)
+
+        return is_motion, contours
+
+    def idle(self, signal=None, timeout=None):
+        self.scheduler.wait(signal, timeout=timeout)
+
+    def pir_gated(self):
+        """
+        'pir' only runs motion detection after a PIR trigger, 'hybrid' does
+        so at night, where the IR illuminator is the cost, and polls by day.
+        """
+        if self.trigger_mode == 'pir':
+            return True
+        return self.trigger_mode == 'hybrid' and not self.is_sunlight()
 
-            self.night_vision(on=not self.is_sunlight(datetime.now()))
-            self.infrared_switch(on=not self.is_sunlight(datetime.now()))
-            logging.info('Polling for Motion')
-            frames = self.capture(self.motion_interval)
-            is_motion, contours = self.motion_detection(frames)
+    def awake(self):
+        now = self.clock.millis()
+        return now < self.pir_until or now <= self.recording_until
 
-            if is_motion:
-                logging.debug(f'Motion Detected and Capturing Started')
-                frames += self.capture(self.video_interval)
-                self.write_event(frames)
-                logging.debug(f'Event captured with contours {contours}')
-                self.put_log([f'"{datetime.now().strftime("%Y-%m-%dT%H:%M:%S")}"', '"EVENT_CAPTURED"', '1',
-                              f'"UUID: {self.event_id}, Contours: {contours}, PIR: {pir1 + pir2}"'])
-            elif not self.is_sunlight(datetime.now()):
-                self.infrared_switch(on=False)
-                time.sleep(self.rest_interval)
+    def pir_triggered(self, pin):
+        # Runs on the GPIO thread
+        self.pir_until = self.clock.millis() + self.pir_hold * 1000
+        self.pir_signal.set()
 
     def open_camera(self):
-        self.camera = cv2.VideoCapture(gstreamer_pipeline(flip_method=0), cv2.CAP_GSTREAMER)
-        if self.camera.isOpened():
-            for skip in range(35):
-                _ = self.camera.read()
+        self.grabber = FrameGrabber(gstreamer_pipeline(flip_method=0), sample_every=self.frames_per_sec,
+                                    capacity=self.ring_capacity)
+        return self.grabber.open()
 
-            return True
-        return False
+    @property
+    def ring_capacity(self):
+        # One sampled frame per second. Windows are copied out of the ring,
+        # only the pre-roll must still be there when write_event runs, the
+        # motion window and two spare slots give detection time to finish
+        return self.pre_roll + self.motion_interval + 2
 
     def capture(self, interval):
         frames = []
+        self.grabber.sample_every = self.frames_per_sec
+        self.grabber.ensure_capacity(self.ring_capacity)
+        start = time.perf_counter()
         for sec in range(interval):
-            for skip in range(self.frames_per_sec - 1):
-                _ = self.camera.read()
+            timestamp, frame = self.grabber.read()
+            if frame is None:
+                raise RuntimeError('Camera stopped delivering frames')
 
-            ret_val, frame = self.camera.read()
-            if not self.is_sunlight(datetime.now()):
+            # The frame is a view into the grabber's ring, detection can take
+            # longer than the few spare slots, so the window keeps its own copy
+            if not self.is_sunlight():
                 frame = ImageOperations.convert_image_to_gray(frame)
+            else:
+                frame = frame.copy()
 
-            frames.append((str(current_milli_time()) + '.jpg', frame))
+            frames.append((str(timestamp) + '.jpg', frame))
+            if timestamp <= self.recording_until:
+                self.stream(frames[-1:])
 
+        self.metrics.count('frames', len(frames))
+        self.metrics.gauge('capture_fps', round(len(frames) / (time.perf_counter() - start), 2))
         return frames
 
+    def setup_detector(self):
+        detector_class = DETECTORS.get(self.detector_type, DETECTORS['first_frame'])
+        if type(self.motion_detector) is not detector_class or self.motion_detector.scale != self.pyramid_scale:
+            self.motion_detector = create_detector(self.detector_type, mask=self.mask, scale=self.pyramid_scale)
+            logging.info(f'Using {type(self.motion_detector).__name__}')
+
     def motion_detection(self, frames):
         max_contours = []
-        _, first_frame = frames[0]
+        baseline_areas = []
+        self.motion_detector.start_window()
+        regime = 'day' if self.is_sunlight() else 'night'
+        threshold = self.motion_threshold(regime)
 
         for _, frame in frames:
-            diff = ImageOperations.error_image_gray_histmatch(first_frame, frame)
-            diff = ImageOperations.convert_to_binary(diff)
-            if self.mask is not None:
-                diff = cv2.bitwise_and(diff, diff, mask=self.mask)
-            diff = cv2.erode(diff, None, iterations=1)
-            diff = cv2.dilate(diff, None, iterations=3)
-            cnts, _ = cv2.findContours(diff.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            max_contour = max([cv2.contourArea(cnt) for cnt in cnts] or [0])
+            max_contour = self.contour_area(frame, threshold)
             max_contours.append(max_contour)
-
-            threshold = self.day_threshold if self.is_sunlight(datetime.now()) else self.night_threshold
+            if self.motion_detector.compared:
+                baseline_areas.append(max_contour)
 
             if threshold < max_contour:
                 return True, max_contour
 
+        if self.adaptive_threshold:
+            self.baseline.update(regime, baseline_areas, self.threshold_alpha)
         return False, max_contours
 
+    def motion_threshold(self, regime):
+        """
+        The ME.json threshold of the regime, or in adaptive mode the noise
+        baseline of windows without motion plus threshold_deviations standard
+        deviations, between the ME.json value and threshold_ceiling times it.
+        """
+        threshold = self.day_threshold if regime == 'day' else self.night_threshold
+        if self.adaptive_threshold:
+            threshold = self.baseline.threshold(regime, threshold, threshold * self.threshold_ceiling,
+                                                self.threshold_deviations)
+        self.metrics.gauge(regime + '_threshold', round(threshold))
+        return threshold
+
+    def contour_area(self, frame, threshold):
+        """
+        Largest contour area of the frame in full resolution pixels.
+        In pyramid mode the coarse area is checked against the threshold scaled
+        down by scale ** 2 and the frame is only redone at full resolution when
+        the two are within pyramid_margin of each other.
+        """
+        with self.metrics.timer('detection_ms'):
+            return self.scaled_contour_area(frame, threshold)
+
+    def scaled_contour_area(self, frame, threshold):
+        scale = self.motion_detector.scale
+        area = self.motion_detector.apply(frame)
+        if scale >= 1:
+            return area
+
+        coarse_threshold = threshold * scale ** 2
+        if abs(area - coarse_threshold) <= self.pyramid_margin * coarse_threshold:
+            fine_area = self.motion_detector.refine()
+            if fine_area is not None:
+                return fine_area
+
+        return area / scale ** 2
+
     def download_roi_mask(self):
-        if self.ME['roi_mask']:
+        if self.roi_mask:
             try:
-                response = requests.get(self.ME['roi_mask'])
+                response = requests.get(self.roi_mask)
             except Exception:
                 logging.warn(f'Error while fetching roi_mask')
                 pass
@@ -133,45 +273,78 @@ class Capture(Constants):
             pass
 
     def write_event(self, frames):
-        event_path = os.path.join(self.events_dir, self.event_id)
-
-        if not os.path.exists(event_path):
-            os.makedirs(event_path)
-
+        first_timestamp = int(frames[0][0][:-4])
+        pre_roll = self.grabber.recent(first_timestamp - self.pre_roll * 1000, first_timestamp)
+        if not self.is_sunlight():
+            pre_roll = [(timestamp, ImageOperations.convert_image_to_gray(frame)) for timestamp, frame in pre_roll]
+
+        self.event_created = pre_roll[0][0] if pre_roll else first_timestamp
+        self.stream([(str(timestamp) + '.jpg', frame) for timestamp, frame in pre_roll] + frames)
+
+    def stream(self, frames):
+        # Pre-roll frames are views into the grabber's ring. They are copied
+        # before the first write(), which blocks while the writer queue is
+        # full and the grabber keeps refilling ring slots meanwhile
+        copies = []
         for filename, frame in frames:
-            cv2.imwrite(event_path + '/' + filename, frame)
-
-    def is_sunlight(self, dt):
-        return self.sunrise.time() < dt.time() < self.sunset.time()
+            if self.dedup and self.duplicates.is_duplicate(self.event_id, frame, self.dedup_threshold,
+                                                           self.dedup_max_skip):
+                self.metrics.count('frames_deduplicated')
+                continue
+            self.streamed += 1
+            if self.storage_state == 'stop' or (self.storage_state == 'reduce' and self.streamed % 2):
+                # Under storage pressure events are recorded at half the frame rate, or not at all
+                self.metrics.count('frames_dropped')
+                continue
+            copies.append((filename, frame if frame.flags.owndata else frame.copy()))
+
+        for filename, frame in copies:
+            self.writer.write(self.event_id, filename, frame, self.event_created)
+
+    def log_duplicates(self):
+        # Called once the event's recording window is over, or a new event starts
+        skipped = self.duplicates.start(None)
+        if skipped:
+            self.put_log('FRAMES_SKIPPED', f'UUID: {self.event_id}, Near duplicate frames dropped from local '
+                                           f'storage, not written or uploaded: {skipped}')
+
+    def check_storage(self):
+        # Eviction and the done_dir index are left to the uploader, capture
+        # only follows events_dir, where unchanged events aren't walked again
+        mb = self.storage.MB
+        self.storage.refresh('events')
+        state = self.storage.pressure(self.events_quota_mb * mb, self.min_free_mb * mb)
+        self.metrics.gauge('events_mb', round(self.storage.size('events') / mb, 1))
+        if state != self.storage_state:
+            logging.warning(f'Storage state {self.storage_state} -> {state}')
+            self.put_log('STORAGE_' + state.upper(), f'Events: {self.storage.size("events") // self.storage.MB}MB, '
+                                                      f'free: {self.storage.free_space() // self.storage.MB}MB')
+            self.storage_state = state
+
+    def write_failed(self, event_id, filename, error):
+        # Runs on a writer thread
+        self.metrics.count('write_failures')
+        self.put_log('WRITE_FAILED', f'UUID: {event_id}, Image: {filename}, Error: {error}')
+
+    def enqueue_upload(self, event, filename, created):
+        with self.db:
+            self.db.enqueue([(event, filename, created)])
+        self.upload_signal.notify()
 
     def night_vision(self, on):
-        if on:
-            GPIO.output(self.filter_a, GPIO.HIGH)
-            GPIO.output(self.filter_b, GPIO.LOW)
-        else:
-            GPIO.output(self.filter_a, GPIO.LOW)
-            GPIO.output(self.filter_b, GPIO.HIGH)
+        self.hardware.night_vision(on)
 
     def infrared_switch(self, on):
-        if on:
-            self.pwm_obj.ChangeDutyCycle(self.pwm)
-        else:
-            self.pwm_obj.ChangeDutyCycle(0)
+        self.hardware.infrared_switch(on, self.pwm)
 
     def close_camera(self):
-        self.infrared_switch(on=False)
-        self.camera.release()
+        self.log_duplicates()
+        self.grabber.stop()
+        self.writer.close()
+        self.hardware.close()
 
     def setup_sensors(self):
-        GPIO.setwarnings(False)
-        GPIO.setmode(GPIO.BOARD)
-        GPIO.setup(self.infrared, GPIO.OUT)
-        self.pwm_obj = GPIO.PWM(self.infrared, 100)
-        self.pwm_obj.start(0)
-        GPIO.setup(self.filter_a, GPIO.OUT)
-        GPIO.setup(self.filter_b, GPIO.OUT)
-        GPIO.setup(self.motion1, GPIO.IN)
-        GPIO.setup(self.motion2, GPIO.IN)
+        self.hardware = Hardware(self.infrared, self.filter_a, self.filter_b, (self.motion1, self.motion2))
 
 
 if __name__ == "__main__":
@@ -181,8 +354,7 @@ if __name__ == "__main__":
         if capture.open_camera():
             capture.run()
         else:
-            capture.put_log([f'"{datetime.now().strftime("%Y-%m-%dT%H:%M:%S")}"',
-                             '"CAMERA_ERROR"', '1', '"Unable to open camera!"'])
+            capture.put_log('CAMERA_ERROR', 'Unable to open camera!')
             logging.error('Unable to open camera!')
     except KeyboardInterrupt:
         capture.close_camera()
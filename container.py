@@ -0,0 +1,89 @@
+import logging
+import os
+import shutil
+import struct
+
+
+class EventContainer:
+    """
+    Single file holding every frame of an event.
+    The file is a sequence of records, a fixed header (magic, timestamp in
+    millis, jpg length, done flag) followed by the jpg bytes. Records are only
+    ever appended, the done flag is the one byte updated in place.
+    A record that is still being appended is ignored until it is complete.
+    Frames are addressed by the same '<millis>.jpg' names as in event directories.
+    """
+    HEADER = struct.Struct('<4sqIB')
+    MAGIC = b'CTF1'
+    EXTENSION = '.ctr'
+
+    def __init__(self, path):
+        self.path = path
+        self.index = {}
+        self.end = 0
+        self.refresh()
+
+    @staticmethod
+    def is_container(name):
+        return name.endswith(EventContainer.EXTENSION)
+
+    @staticmethod
+    def append(path, timestamp, data):
+        record = EventContainer.HEADER.pack(EventContainer.MAGIC, timestamp, len(data), 0) + bytes(data)
+        with open(path, 'ab') as file:
+            file.write(record)
+
+    @property
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def refresh(self):
+        """Indexes the records appended since the last call."""
+        size = self.size
+        if size <= self.end:
+            return
+
+        with open(self.path, 'rb') as file:
+            file.seek(self.end)
+            while self.end + self.HEADER.size <= size:
+                magic, timestamp, length, done = self.HEADER.unpack(file.read(self.HEADER.size))
+                if magic != self.MAGIC:
+                    logging.error(f'Corrupted record at {self.end} in {self.path}')
+                    break
+                if self.end + self.HEADER.size + length > size:
+                    break
+                self.index[str(timestamp) + '.jpg'] = [self.end, length, done]
+                self.end += self.HEADER.size + length
+                file.seek(self.end)
+
+    def pending(self):
+        return sorted(item for item, (_, _, done) in self.index.items() if not done)
+
+    def read(self, item):
+        offset, length, _ = self.index[item]
+        with open(self.path, 'rb') as file:
+            file.seek(offset + self.HEADER.size)
+            return file.read(length)
+
+    def mark_done(self, item):
+        record = self.index[item]
+        with open(self.path, 'r+b') as file:
+            file.seek(record[0] + self.HEADER.size - 1)
+            file.write(b'\x01')
+        record[2] = 1
+
+    def move_to(self, done_path):
+        """
+        Moves the container to done_path, frames appended after an earlier
+        move are added to the end of the container already there.
+        """
+        if not os.path.exists(done_path):
+            shutil.move(self.path, done_path)
+            return
+
+        with open(self.path, 'rb') as src, open(done_path, 'ab') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(self.path)
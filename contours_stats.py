@@ -1,11 +1,18 @@
+import argparse
+import json
 import logging
+import math
+import os
 import statistics
-from datetime import datetime
+from multiprocessing import Pool
 
-import Jetson.GPIO as GPIO
 import cv2
+import numpy as np
 
-from utils import gstreamer_pipeline, current_milli_time, Constants, ImageOperations
+from container import EventContainer
+from hardware import Hardware
+from utils import gstreamer_pipeline, current_milli_time, Constants, ImageOperations, HistogramMatcher, \
+    MotionDetector
 
 
 class Contours(Constants):
@@ -16,13 +23,13 @@ class Contours(Constants):
         self.setup_sensors()
 
     def run(self):
-        self.night_vision(on=not self.is_sunlight(datetime.now()))
-        self.infrared_switch(on=not self.is_sunlight(datetime.now()))
+        self.hardware.night_vision(on=not self.is_sunlight())
+        self.hardware.infrared_switch(on=not self.is_sunlight(), duty_cycle=self.pwm)
         logging.info('Polling for Motion')
         frames = self.capture(self.motion_interval)
         frames += self.capture(self.video_interval)
         contours = self.motion_detection(frames)
-        self.infrared_switch(on=False)
+        self.hardware.infrared_switch(on=False, duty_cycle=self.pwm)
         print(f'MAX contour:{max(contours)}')
         print(f'MEAN contour:{statistics.mean(contours)}')
         print(f'MIN contour:{min(contours)}')
@@ -43,7 +50,7 @@ class Contours(Constants):
         frames = []
         for sec in range(interval):
             ret_val, frame = self.camera.read()
-            if not self.is_sunlight(datetime.now()):
+            if not self.is_sunlight():
                 frame = ImageOperations.convert_image_to_gray(frame)
 
             frames.append((str(current_milli_time()) + '.jpg', frame))
@@ -55,60 +62,188 @@ class Contours(Constants):
 
     def motion_detection(self, frames):
         max_contours = []
+        matcher = HistogramMatcher()
 
         for i in range(len(frames)-1):
             _, frame_1 = frames[i]
             _, frame_2 = frames[i+1]
-
-            diff = ImageOperations.error_image_gray_histmatch(frame_1, frame_2)
-            diff = ImageOperations.convert_to_binary(diff)
-            diff = cv2.erode(diff, None, iterations=1)
-            diff = cv2.dilate(diff, None, iterations=3)
-            cnts, _ = cv2.findContours(diff.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            max_contour = max([cv2.contourArea(cnt) for cnt in cnts] or [0])
-            max_contours.append(max_contour)
+            max_contours.append(pair_contour(frame_1, frame_2, matcher))
 
         return max_contours
 
-    def is_sunlight(self, dt):
-        return self.sunrise.time() < dt.time() < self.sunset.time()
-
-    def night_vision(self, on):
-        if on:
-            GPIO.output(self.filter_a, GPIO.HIGH)
-            GPIO.output(self.filter_b, GPIO.LOW)
-        else:
-            GPIO.output(self.filter_a, GPIO.LOW)
-            GPIO.output(self.filter_b, GPIO.HIGH)
-
-    def infrared_switch(self, on):
-        if on:
-            self.pwm_obj.ChangeDutyCycle(self.pwm)
-        else:
-            self.pwm_obj.ChangeDutyCycle(0)
-
     def close_camera(self):
-        self.infrared_switch(on=False)
         self.camera.release()
+        self.hardware.close()
 
     def setup_sensors(self):
-        GPIO.setwarnings(False)
-        GPIO.setmode(GPIO.BOARD)
-        GPIO.setup(self.infrared, GPIO.OUT)
-        self.pwm_obj = GPIO.PWM(self.infrared, 100)
-        self.pwm_obj.start(0)
-        GPIO.setup(self.filter_a, GPIO.OUT)
-        GPIO.setup(self.filter_b, GPIO.OUT)
-        GPIO.setup(self.motion1, GPIO.IN)
-        GPIO.setup(self.motion2, GPIO.IN)
+        self.hardware = Hardware(self.infrared, self.filter_a, self.filter_b, (self.motion1, self.motion2))
+
+
+def pair_contour(frame_1, frame_2, matcher):
+    """
+    Largest contour of the difference of two consecutive frames, the same
+    measure FirstFrameDetector compares against the thresholds.
+    """
+    frame_1 = ImageOperations.convert_image_to_gray(frame_1)
+    matcher.set_reference(frame_1)
+    diff = ImageOperations.error_image_gray_histmatch(frame_1, frame_2, matcher=matcher)
+    return MotionDetector.max_contour(ImageOperations.convert_to_binary(diff))
+
+
+def read_event_frames(path):
+    """
+    (timestamp, frame) of an archived event, a directory of jpgs or a
+    container, oldest first. Night frames were stored in gray, so they come
+    back with a single channel.
+    """
+    if EventContainer.is_container(path):
+        container = EventContainer(path)
+        items = sorted(container.index, key=lambda item: int(item[:-4]))
+        data = ((item, container.read(item)) for item in items)
+    else:
+        items = sorted((item for item in os.listdir(path) if item.endswith('.jpg')), key=lambda item: int(item[:-4]))
+        data = ((item, np.fromfile(os.path.join(path, item), np.uint8)) for item in items)
+
+    for item, buffer in data:
+        frame = cv2.imdecode(np.frombuffer(buffer, np.uint8), cv2.IMREAD_UNCHANGED)
+        if frame is not None:
+            yield int(item[:-4]), frame
+
+
+def event_contours(path):
+    """
+    Pool worker: the max contour series of one event as (period, area) pairs,
+    the period being 'night' when the frames are gray.
+    """
+    series = []
+    matcher = HistogramMatcher()
+    previous = None
+    try:
+        for _, frame in read_event_frames(path):
+            if previous is not None and previous.shape == frame.shape:
+                period = 'night' if frame.ndim == 2 else 'day'
+                series.append((period, pair_contour(previous, frame, matcher)))
+            previous = frame
+    except (OSError, ValueError):
+        logging.warning(f'Could not read event {path}')
+    return series
+
+
+class StreamingStats:
+    """
+    Single pass statistics of a series: Welford mean and variance, and
+    percentiles from a histogram with log spaced bins, each bin being
+    5% wider than the one before.
+    """
+    GROWTH = 1.05
+    BINS = 400
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.bins = np.zeros(self.BINS + 1, dtype=np.int64)
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        # Bin 0 holds areas below 1 px
+        index = 0 if value < 1 else min(self.BINS, 1 + int(math.log(value, self.GROWTH)))
+        self.bins[index] += 1
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        index = int(np.searchsorted(np.cumsum(self.bins), q * self.count))
+        # Upper edge of the bin, never past the largest value seen
+        return min(self.max, 1.0 if index == 0 else self.GROWTH ** index)
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': round(self.mean, 1),
+            'std': round(self.std, 1),
+            'min': round(self.min, 1) if self.count else 0.0,
+            'max': round(self.max, 1),
+            'p50': round(self.percentile(0.5), 1),
+            'p90': round(self.percentile(0.9), 1),
+            'p95': round(self.percentile(0.95), 1),
+            'p99': round(self.percentile(0.99), 1),
+        }
+
+
+def analyze(done_dirs, deviations=2, processes=None):
+    """
+    Max contour statistics per camera and day/night period over every event
+    in done_dirs, a {camera: done_dir} dict, with recommended thresholds of
+    mean + deviations * std like the live run prints.
+    """
+    jobs = [(camera, os.path.join(done_dir, event))
+            for camera, done_dir in done_dirs.items() for event in sorted(os.listdir(done_dir))]
+    stats = {}
+    with Pool(processes) as pool:
+        results = pool.imap(event_contours, [path for _, path in jobs], chunksize=8)
+        for (camera, _), series in zip(jobs, results):
+            for period, area in series:
+                stats.setdefault(camera, {}).setdefault(period, StreamingStats()).add(area)
+
+    report = {}
+    for camera, periods in stats.items():
+        report[camera] = {period: period_stats.summary() for period, period_stats in periods.items()}
+        for period, period_stats in periods.items():
+            report[camera][period + '_threshold'] = round(period_stats.mean + deviations * period_stats.std)
+    return report
+
+
+def parse_done_dirs(paths):
+    """
+    Cameras named after their directory, or after the directory above for a
+    path ending in done, e.g. traps/trap_7/data_root/done -> trap_7.
+    """
+    done_dirs = {}
+    for path in paths:
+        # Relative paths like data_root/done are named after the working directory
+        path = os.path.abspath(path)
+        parts = path.split(os.sep)
+        camera = parts[-3] if parts[-1] == 'done' and len(parts) >= 3 and parts[-2] == Constants.data_root else \
+            parts[-1]
+        done_dirs[camera] = path
+    return done_dirs
 
 
 if __name__ == "__main__":
     logging.basicConfig(format='%(asctime)s - capture:%(levelname)s - %(message)s', level=logging.DEBUG)
-    contours = Contours()
-    try:
-        if contours.open_camera():
-            contours.run()
-            logging.error('Unable to open camera!')
-    except KeyboardInterrupt:
-        contours.close_camera()
+    parser = argparse.ArgumentParser(description='Contour statistics of a live window, or of archived events')
+    parser.add_argument('--batch', nargs='*', metavar='DONE_DIR',
+                        help='analyze archived events, this trap\'s done_dir if no directory is given')
+    parser.add_argument('--deviations', type=float, default=2, help='recommended threshold is mean + this * std')
+    parser.add_argument('--processes', type=int, help='worker processes, all cores by default')
+    parser.add_argument('--output', help='also write the batch report to this JSON file')
+    args = parser.parse_args()
+
+    if args.batch is not None:
+        done_dirs = parse_done_dirs(args.batch) if args.batch else {'local': Constants.done_dir}
+        report = analyze(done_dirs, args.deviations, args.processes)
+        print(json.dumps(report, indent=4))
+        if args.output:
+            with open(args.output, 'w') as file:
+                file.write(json.dumps(report, indent=4))
+    else:
+        contours = Contours()
+        try:
+            if contours.open_camera():
+                contours.run()
+            else:
+                logging.error('Unable to open camera!')
+        except KeyboardInterrupt:
+            contours.close_camera()
@@ -1,58 +1,178 @@
+import atexit
+import logging
 import sqlite3
+import threading
+import time
 from datetime import datetime
 
 
 class SQLite:
+    """
+    One long lived connection in WAL mode, shared by the threads of a process.
+    Every `with` block is a single write transaction, readers in the other
+    processes are not blocked by it.
+    """
     _DEFAULT_TIMEOUT = 60 * 60  # 1hr
 
     def __init__(self, db_path: str, timeout: float = _DEFAULT_TIMEOUT):
         self._db_path = db_path
         self._db_conn = None
         self._timeout = timeout
+        self._lock = threading.RLock()
+        # Called with the seconds spent waiting for the write lock
+        self.on_lock_wait = None
+
+    def connect(self):
+        if self._db_conn is None:
+            self._db_conn = sqlite3.connect(self._db_path, timeout=self._timeout, check_same_thread=False)
+            self._db_conn.isolation_level = None
+            self._db_conn.execute("PRAGMA journal_mode = WAL;")
+            self._db_conn.execute("PRAGMA synchronous = NORMAL;")
+        return self._db_conn
+
+    def close(self):
+        with self._lock:
+            if self._db_conn is not None:
+                self._db_conn.close()
+                self._db_conn = None
 
     def __enter__(self):
-        self._db_conn = sqlite3.connect(self._db_path, timeout=self._timeout)
-        self._db_conn.isolation_level = None
-        self._db_conn.execute("PRAGMA locking_mode = EXCLUSIVE;")
-        self._db_conn.execute("BEGIN EXCLUSIVE;")
+        start = time.perf_counter()
+        self._lock.acquire()
+        try:
+            self.connect().execute("BEGIN IMMEDIATE;")
+        except Exception:
+            self._lock.release()
+            raise
+        if self.on_lock_wait is not None:
+            self.on_lock_wait(time.perf_counter() - start)
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self._db_conn.execute("COMMIT;")
-        self._db_conn.close()
-        self._db_conn = None
+        try:
+            self._db_conn.execute("ROLLBACK;" if exc_type else "COMMIT;")
+        finally:
+            self._lock.release()
 
     def create_tables(self):
         self._db_conn.execute('CREATE TABLE IF NOT EXISTS capture_logs(datestamp TEXT, log_type TEXT , pending INT, message TEXT)')
         self._db_conn.execute('CREATE TABLE IF NOT EXISTS upload_logs(datestamp TEXT, log_type TEXT, pending INT, message TEXT)')
+        self._db_conn.execute('CREATE TABLE IF NOT EXISTS upload_queue(event TEXT, item TEXT, created INT, '
+                              'attempts INT DEFAULT 0, next_attempt INT DEFAULT 0, PRIMARY KEY(event, item))')
+        columns = [row[1] for row in self._db_conn.execute('PRAGMA table_info(upload_queue)')]
+        if 'attempts' not in columns:
+            self._db_conn.execute('ALTER TABLE upload_queue ADD COLUMN attempts INT DEFAULT 0')
+            self._db_conn.execute('ALTER TABLE upload_queue ADD COLUMN next_attempt INT DEFAULT 0')
+        self._db_conn.execute('CREATE INDEX IF NOT EXISTS upload_queue_order ON upload_queue(created DESC, item)')
+        self._db_conn.execute('CREATE INDEX IF NOT EXISTS upload_queue_due ON upload_queue(next_attempt)')
+        self._db_conn.execute('CREATE INDEX IF NOT EXISTS capture_logs_pending ON capture_logs(pending)')
+        self._db_conn.execute('CREATE INDEX IF NOT EXISTS upload_logs_pending ON upload_logs(pending)')
 
     def data_entry(self, table_name, values):
-        values_csv = ','.join(values)
-        self._db_conn.execute(f'INSERT INTO {table_name} VALUES({values_csv})')
-
-    def get_pending_logs(self, ):
-        c = self._db_conn.cursor()
-        c.execute('SELECT * FROM capture_logs WHERE pending==1')
-        capture_logs = [row for row in c.fetchall()]
-        c.execute('SELECT * FROM upload_logs WHERE pending==1')
-        upload_logs = [row for row in c.fetchall()]
-        return capture_logs, upload_logs
-
-    def delete_done(self, clogs, ulogs):
-        c = self._db_conn.cursor()
-        cdates = ','.join([f'"{row[0]}"' for row in clogs])
-        c.execute(f'DELETE FROM capture_logs WHERE datestamp IN ({cdates})')
-        udates = ','.join([f'"{row[0]}"' for row in ulogs])
-        c.execute(f'DELETE FROM upload_logs WHERE datestamp IN ({udates})')
-        return
+        self.data_entries(table_name, [values])
+
+    def data_entries(self, table_name, rows):
+        self._db_conn.executemany(f'INSERT INTO {table_name} VALUES(?, ?, ?, ?)', rows)
+
+    def enqueue(self, rows):
+        """
+        Adds (event, item, created) rows to the upload queue, rows already queued are ignored.
+        :return: number of rows added
+        """
+        return self._db_conn.executemany('INSERT OR IGNORE INTO upload_queue(event, item, created) VALUES(?, ?, ?)', rows).rowcount
+
+    def dequeue(self, limit, now):
+        """
+        (event, item, attempts) rows due at `now` (millis), newest event first and
+        frames of an event in order. Rows stay queued until removed.
+        """
+        c = self._db_conn.execute('SELECT event, item, attempts FROM upload_queue WHERE next_attempt <= ? '
+                                  'ORDER BY created DESC, item LIMIT ?', (now, limit))
+        return c.fetchall()
+
+    def defer(self, event, item, next_attempt):
+        self._db_conn.execute('UPDATE upload_queue SET attempts = attempts + 1, next_attempt = ? '
+                              'WHERE event=? AND item=?', (next_attempt, event, item))
+
+    def next_due(self):
+        return self._db_conn.execute('SELECT MIN(next_attempt) FROM upload_queue').fetchone()[0]
+
+    def clear_backoff(self):
+        self._db_conn.execute('UPDATE upload_queue SET next_attempt = 0 WHERE next_attempt > 0')
+
+    def remove_queued(self, event, item):
+        self._db_conn.execute('DELETE FROM upload_queue WHERE event=? AND item=?', (event, item))
+
+    def queue_size(self):
+        return self._db_conn.execute('SELECT COUNT(*) FROM upload_queue').fetchone()[0]
+
+    def get_pending_page(self, table_name, after_rowid, limit):
+        """
+        Up to `limit` pending rows with rowid > after_rowid, as (rowid, datestamp, log_type, pending, message)
+        """
+        c = self._db_conn.execute(f'SELECT rowid, * FROM {table_name} WHERE pending=1 AND rowid > ? '
+                                  f'ORDER BY rowid LIMIT ?', (after_rowid, limit))
+        return c.fetchall()
+
+    def delete_rows(self, table_name, rowids):
+        # Older sqlite builds allow at most 999 parameters per statement
+        for start in range(0, len(rowids), 500):
+            chunk = rowids[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            self._db_conn.execute(f'DELETE FROM {table_name} WHERE rowid IN ({placeholders})', chunk)
+
+
+class BufferedWriter:
+    """
+    Collects log rows and inserts them in one transaction per flush.
+    A flush happens on a background thread once `batch_size` rows are waiting
+    or `interval` seconds after the last one, callers never wait on the database.
+    """
+
+    def __init__(self, db: SQLite, batch_size: int = 50, interval: float = 5):
+        self._db = db
+        self._batch_size = batch_size
+        self._interval = interval
+        self._rows = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._full = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+        atexit.register(self.flush)
+
+    def add(self, table_name, values):
+        with self._lock:
+            self._rows.setdefault(table_name, []).append(values)
+            self._count += 1
+            if self._count >= self._batch_size:
+                self._full.set()
+
+    def flush(self):
+        with self._lock:
+            rows, self._rows, self._count = self._rows, {}, 0
+        if not rows:
+            return
+
+        try:
+            with self._db:
+                for table_name, values in rows.items():
+                    self._db.data_entries(table_name, values)
+        except sqlite3.Error:
+            logging.exception(f'Could not write {sum(len(v) for v in rows.values())} log rows')
+
+    def _run(self):
+        while True:
+            self._full.wait(self._interval)
+            self._full.clear()
+            self.flush()
 
 
 if __name__ == '__main__':
     database = SQLite("local.db", 5)
     with database:
         database.create_tables()
-        database.data_entry('capture_logs', [f'"{datetime.now().strftime("%Y-%m-%dT%H:%M:%S")}"', '"EVENT_CAPTURED"', '1', '"some thing about log"'])
-        database.data_entry('upload_logs', [f'"{datetime.now().strftime("%Y-%m-%dT%H:%M:%S")}"', '"CHECKED_MOTION"', '1', '"some thing about log"'])
-        clogs, ulogs = database.get_pending_logs()
-        # database.mark_done(clogs, ulogs)
+        database.data_entry('capture_logs', (datetime.now().strftime("%Y-%m-%dT%H:%M:%S"), 'EVENT_CAPTURED', 1, 'some thing about log'))
+        database.data_entry('upload_logs', (datetime.now().strftime("%Y-%m-%dT%H:%M:%S"), 'CHECKED_MOTION', 1, 'some thing about log'))
+        clogs = database.get_pending_page('capture_logs', 0, 500)
+        database.delete_rows('capture_logs', [row[0] for row in clogs])
         print('acquired lock!')
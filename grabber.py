@@ -0,0 +1,209 @@
+import logging
+import threading
+
+import cv2
+import numpy as np
+
+from utils import current_milli_time
+
+
+class FrameRing:
+    """
+    The last `capacity` sampled frames, kept in one preallocated block with a
+    timestamp per slot. Frames are handed out as views into the block, they
+    stay valid until capacity - 1 newer frames have been committed.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.frames = None
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.head = 0
+        self.count = 0
+
+    def allocate(self, shape):
+        self.frames = np.empty((self.capacity,) + shape, dtype=np.uint8)
+
+    def next_slot(self):
+        return self.frames[self.head]
+
+    def commit(self, timestamp):
+        index = self.head
+        self.timestamps[index] = timestamp
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        return self.frames[index]
+
+    def between(self, start, end):
+        """
+        Frames with start <= timestamp < end, oldest first.
+        The oldest slot of a full ring is skipped, it is the one being refilled.
+        """
+        count = min(self.count, self.capacity - 1)
+        frames = []
+        for offset in range(count, 0, -1):
+            index = (self.head - offset) % self.capacity
+            timestamp = int(self.timestamps[index])
+            if start <= timestamp < end:
+                frames.append((timestamp, self.frames[index]))
+        return frames
+
+
+class FrameGrabber(threading.Thread):
+    """
+    Owns the cv2.VideoCapture and keeps draining it on its own thread.
+    Skipped frames are only grab()bed, every sample_every-th frame is
+    retrieve()d straight into a FrameRing slot and stamped with the time it
+    was grabbed. Consumers get the latest sampled frame, older ones are only
+    kept in the ring.
+    While paused the camera is released, the whole GStreamer pipeline stops
+    until resume() opens it again.
+    """
+
+    def __init__(self, pipeline, sample_every=1, warmup=35, capacity=16):
+        super().__init__(daemon=True)
+        self.pipeline = pipeline
+        self.sample_every = sample_every
+        self.warmup = warmup
+        self.ring = FrameRing(capacity)
+        self.capacity = capacity
+        self.camera = None
+        self.running = False
+        self.paused = False
+        self.waking = False
+        self.frame = None
+        self.timestamp = None
+        self.sequence = 0
+        self.consumed = 0
+        self.condition = threading.Condition()
+
+    def open(self):
+        if not self.open_camera():
+            return False
+
+        self.running = True
+        self.start()
+        return True
+
+    def open_camera(self):
+        self.camera = cv2.VideoCapture(self.pipeline, cv2.CAP_GSTREAMER)
+        if not self.camera.isOpened():
+            return False
+
+        for skip in range(self.warmup):
+            self.camera.grab()
+        return True
+
+    def sleep(self):
+        """
+        Releases the camera until resume() or stop(), then opens it again.
+        :return: False if the grabber should stop
+        """
+        self.camera.release()
+        logging.info('Camera released while paused')
+        with self.condition:
+            self.condition.wait_for(lambda: not self.paused or not self.running)
+        if not self.running:
+            return False
+        if not self.open_camera():
+            logging.error('Could not open the camera again after a pause')
+            return False
+        return True
+
+    def run(self):
+        try:
+            self.grab_frames()
+        finally:
+            with self.condition:
+                self.running = False
+                self.condition.notify_all()
+
+    def grab_frames(self):
+        skipped = 0
+        while self.running:
+            if self.paused:
+                if not self.sleep():
+                    break
+                continue
+
+            if not self.camera.grab():
+                logging.error('Camera stopped delivering frames')
+                break
+
+            timestamp = current_milli_time()
+            skipped += 1
+            if skipped < self.sample_every:
+                continue
+
+            skipped = 0
+            if self.ring.frames is None or self.ring.capacity != self.capacity:
+                ret_val, frame = self.camera.retrieve()
+                if not ret_val:
+                    continue
+                # Consumers may still hold views into the old block, it is
+                # freed once they let go of them
+                ring = FrameRing(self.capacity)
+                ring.allocate(frame.shape)
+                np.copyto(ring.next_slot(), frame)
+                with self.condition:
+                    self.ring = ring
+            else:
+                slot = self.ring.next_slot()
+                ret_val, frame = self.camera.retrieve(slot)
+                if not ret_val:
+                    continue
+                if frame is not slot:
+                    np.copyto(slot, frame)
+
+            with self.condition:
+                frame = self.ring.commit(timestamp)
+                self.timestamp, self.frame = timestamp, frame
+                self.sequence += 1
+                self.waking = False
+                self.condition.notify_all()
+
+    def read(self, timeout=5, wake_timeout=15):
+        """
+        Waits for the next sampled frame after the last one read, for up to
+        wake_timeout while the camera is being opened again after a pause.
+        :return: (grab timestamp in millis, frame) or (None, None) if the camera stopped
+        """
+        with self.condition:
+            if self.waking:
+                timeout = max(timeout, wake_timeout)
+            if not self.condition.wait_for(lambda: self.sequence > self.consumed or not self.running, timeout):
+                return None, None
+            if self.sequence == self.consumed:
+                return None, None
+            self.consumed = self.sequence
+            return self.timestamp, self.frame
+
+    def recent(self, start, end):
+        with self.condition:
+            return self.ring.between(start, end)
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        if self.paused:
+            with self.condition:
+                # Frames sampled before the pause are stale, read() waits for a new one
+                self.consumed = self.sequence
+                self.paused = False
+                self.waking = True
+                self.condition.notify_all()
+
+    def ensure_capacity(self, capacity):
+        if capacity > self.capacity:
+            logging.info(f'Growing frame ring to {capacity} frames')
+            self.capacity = capacity
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.is_alive():
+            self.join(timeout=2)
+        if self.camera is not None:
+            self.camera.release()
@@ -0,0 +1,172 @@
+import os
+
+
+class SimulatedPWM:
+
+    def __init__(self, gpio, pin, frequency):
+        self.gpio = gpio
+        self.pin = pin
+        self.frequency = frequency
+
+    def start(self, duty_cycle):
+        self.gpio.duty_cycles[self.pin] = duty_cycle
+
+    def ChangeDutyCycle(self, duty_cycle):
+        self.gpio.duty_cycles[self.pin] = duty_cycle
+        self.gpio.writes += 1
+
+    def stop(self):
+        self.gpio.duty_cycles.pop(self.pin, None)
+
+
+class SimulatedGPIO:
+    """
+    Pure Python stand-in for Jetson.GPIO, covering the calls the trap makes.
+    Pin levels and duty cycles are kept in dicts, writes counts every
+    output() and duty cycle change so redundant writes can be measured.
+    """
+    BOARD = 'BOARD'
+    OUT = 'OUT'
+    IN = 'IN'
+    HIGH = 1
+    LOW = 0
+    RISING = 'RISING'
+    FALLING = 'FALLING'
+    BOTH = 'BOTH'
+
+    def __init__(self):
+        self.mode = None
+        self.directions = {}
+        self.levels = {}
+        self.duty_cycles = {}
+        self.callbacks = {}
+        self.writes = 0
+
+    def setwarnings(self, flag):
+        pass
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin, direction):
+        self.directions[pin] = direction
+        self.levels.setdefault(pin, self.LOW)
+
+    def output(self, pin, value):
+        if self.directions.get(pin) != self.OUT:
+            raise RuntimeError(f'Pin {pin} is not set up as an output')
+        self.levels[pin] = value
+        self.writes += 1
+
+    def input(self, pin):
+        return self.levels.get(pin, self.LOW)
+
+    def PWM(self, pin, frequency):
+        return SimulatedPWM(self, pin, frequency)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.callbacks[pin] = (edge, callback)
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def set_input(self, pin, value):
+        """
+        Drives an input pin like a sensor would, edge callbacks run right
+        away on the calling thread.
+        """
+        previous = self.levels.get(pin, self.LOW)
+        self.levels[pin] = value
+        if pin not in self.callbacks or value == previous:
+            return
+        edge, callback = self.callbacks[pin]
+        if callback is not None and edge in (self.BOTH, self.RISING if value else self.FALLING):
+            callback(pin)
+
+    def trigger(self, pin):
+        """A PIR pulse on pin."""
+        self.set_input(pin, self.HIGH)
+        self.set_input(pin, self.LOW)
+
+    def cleanup(self):
+        self.directions.clear()
+        self.duty_cycles.clear()
+        self.callbacks.clear()
+
+
+def gpio_backend():
+    """
+    SimulatedGPIO when CAMERA_TRAP_GPIO=sim is set, Jetson.GPIO otherwise.
+    A trap that can't import Jetson.GPIO fails instead of running without
+    its IR cut filter and illuminator.
+    """
+    if os.environ.get('CAMERA_TRAP_GPIO') == 'sim':
+        return SimulatedGPIO()
+    import Jetson.GPIO as GPIO
+    return GPIO
+
+
+class Hardware:
+    """
+    IR cut filter, IR illuminator and PIR sensors of the trap.
+    The last level written to each pin and the current duty cycle are
+    tracked, a write only reaches the GPIO backend when it changes something.
+    """
+    PWM_FREQUENCY = 100
+    PIR_BOUNCETIME = 200
+
+    def __init__(self, infrared, filter_a, filter_b, motion_pins, gpio=None):
+        self.gpio = gpio_backend() if gpio is None else gpio
+        self.infrared = infrared
+        self.filter_a = filter_a
+        self.filter_b = filter_b
+        self.motion_pins = motion_pins
+        self.levels = {}
+        self.duty_cycle = 0
+
+        self.gpio.setwarnings(False)
+        self.gpio.setmode(self.gpio.BOARD)
+        self.gpio.setup(infrared, self.gpio.OUT)
+        self.pwm_obj = self.gpio.PWM(infrared, self.PWM_FREQUENCY)
+        self.pwm_obj.start(0)
+        self.gpio.setup(filter_a, self.gpio.OUT)
+        self.gpio.setup(filter_b, self.gpio.OUT)
+        for pin in motion_pins:
+            self.gpio.setup(pin, self.gpio.IN)
+
+    def output(self, pin, value):
+        if self.levels.get(pin) != value:
+            self.gpio.output(pin, value)
+            self.levels[pin] = value
+
+    def set_duty_cycle(self, duty_cycle):
+        if duty_cycle != self.duty_cycle:
+            self.pwm_obj.ChangeDutyCycle(duty_cycle)
+            self.duty_cycle = duty_cycle
+
+    def night_vision(self, on):
+        if on:
+            self.output(self.filter_a, self.gpio.HIGH)
+            self.output(self.filter_b, self.gpio.LOW)
+        else:
+            self.output(self.filter_a, self.gpio.LOW)
+            self.output(self.filter_b, self.gpio.HIGH)
+
+    def infrared_switch(self, on, duty_cycle):
+        self.set_duty_cycle(duty_cycle if on else 0)
+
+    def read_motion(self):
+        return [self.gpio.input(pin) for pin in self.motion_pins]
+
+    def watch_motion(self, callback):
+        """
+        Calls callback(pin) from the GPIO backend's thread whenever a PIR
+        sensor goes high.
+        """
+        for pin in self.motion_pins:
+            self.gpio.add_event_detect(pin, self.gpio.RISING, callback=callback, bouncetime=self.PIR_BOUNCETIME)
+
+    def close(self):
+        self.infrared_switch(on=False, duty_cycle=0)
+        self.pwm_obj.stop()
+        self.gpio.cleanup()
@@ -0,0 +1,128 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms of one process, kept in memory and
+    written to a small JSON file by flush(). The file is replaced atomically
+    so the Monitor can read it at any time.
+    Histograms keep counts per bucket (upper bounds in BUCKETS, in ms) plus
+    count, sum and max, percentiles are estimated from the buckets.
+    """
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+    def __init__(self, path=None):
+        self.path = path
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {'count': 0, 'sum': 0, 'max': 0,
+                                                     'buckets': [0] * (len(self.BUCKETS) + 1)}
+            histogram['count'] += 1
+            histogram['sum'] += value
+            histogram['max'] = max(histogram['max'], value)
+            histogram['buckets'][bisect.bisect_left(self.BUCKETS, value)] += 1
+
+    @contextmanager
+    def timer(self, name):
+        """Observes the time spent in the with block in ms."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - start) * 1000)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'started': self.started,
+                'updated': time.time(),
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': {name: dict(h, buckets=list(h['buckets'])) for name, h in self.histograms.items()},
+            }
+
+    def flush(self):
+        if self.path is None:
+            return
+        temp_path = self.path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(temp_path, 'w') as file:
+                file.write(json.dumps(self.snapshot()))
+            os.replace(temp_path, self.path)
+        except OSError:
+            logging.exception(f'Could not write metrics to {self.path}')
+
+    @staticmethod
+    def percentile(histogram, q):
+        target = histogram['count'] * q
+        seen = 0
+        for bound, count in zip(Metrics.BUCKETS, histogram['buckets']):
+            seen += count
+            if seen >= target:
+                return min(bound, round(histogram['max'], 2))
+        return histogram['max']
+
+    @staticmethod
+    def summarize(snapshot):
+        """
+        Compact form of a snapshot: counters with their rate per second since
+        the process started, gauges as they are, histograms as count, mean,
+        p50, p95 and max.
+        """
+        uptime = max(snapshot['updated'] - snapshot['started'], 1)
+        summary = {'uptime': round(uptime)}
+        for name, value in snapshot['counters'].items():
+            summary[name] = value
+            summary[name + '_per_sec'] = round(value / uptime, 2)
+        summary.update(snapshot['gauges'])
+        for name, histogram in snapshot['histograms'].items():
+            if histogram['count']:
+                summary[name] = {
+                    'count': histogram['count'],
+                    'mean': round(histogram['sum'] / histogram['count'], 2),
+                    'p50': Metrics.percentile(histogram, 0.5),
+                    'p95': Metrics.percentile(histogram, 0.95),
+                    'max': round(histogram['max'], 2),
+                }
+        return summary
+
+    @staticmethod
+    def collect(metrics_dir):
+        """
+        Summaries of every metrics file in metrics_dir, keyed by script name.
+        """
+        summaries = {}
+        if not os.path.isdir(metrics_dir):
+            return summaries
+        for filename in sorted(os.listdir(metrics_dir)):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(metrics_dir, filename), 'r') as file:
+                    summaries[filename[:-5]] = Metrics.summarize(json.loads(file.read()))
+            except (OSError, ValueError, KeyError):
+                logging.warning(f'Could not read metrics file {filename}')
+        return summaries
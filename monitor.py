@@ -1,9 +1,11 @@
+import gzip
 import logging
 import json
 from datetime import datetime, timedelta
 
 import requests
 
+from metrics import Metrics
 from utils import Constants, get_disk_usage, format_logs
 
 
@@ -19,32 +21,29 @@ class Monitor(Constants):
             self.db.create_tables()
 
         logging.info(f'Checked Tables')
+        self.scheduler.every(lambda: self.update_after, self.refresh)
+
+    def refresh(self):
+        self.fetch_params()
+        self.send_logs()
 
     def run(self):
         while True:
-            if self.params_expired:
-                self.fetch_params()
-                # self.send_logs()
-
-    def read_params(self):
-        try:
-            with open(self.data_dir + '/ME.json', 'r') as file:
-                self.ME = json.loads(file.read())
-            logging.debug("ME.json loaded.")
-        except IOError as e:
-            logging.debug("Couldn't find/open ME.json file.")
+            self.scheduler.run_pending()
+            self.scheduler.wait()
 
     def fetch_params(self):
         try:
             payload = {
                 "remaining_storage": get_disk_usage(),
                 'last_reported_at': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+                'metrics': Metrics.collect(self.metrics_dir),
             }
             response = requests.request("PATCH", self.me_url, headers=self.headers,
                                         data=json.dumps(payload), timeout=10)
+            # Validated before it is written, the other scripts never see a bad or half written file
             self.ME = json.loads(response.text)
-            with open(self.data_dir + '/ME.json', 'w') as file:
-                file.write(json.dumps(self.ME, indent=4))
+            self.write_params(self.ME)
 
             logging.info(f'Fetched ME.json')
         except Exception:
@@ -52,16 +51,36 @@ class Monitor(Constants):
             pass
 
     def send_logs(self):
-        with self.db:
-            clogs, ulogs = self.db.get_pending_logs()
-
-        logs = format_logs(clogs, ulogs)
-        response = requests.request("POST", self.logs_url, headers=self.headers,
-                                    data=json.dumps(logs), timeout=10)
-        if response.status_code == 201:
-            logging.info(f'Logs uploaded successfully')
-            with self.db:
-                self.db.delete_done(clogs, ulogs)
+        """
+        Ships pending logs a page at a time, walking each table by rowid so
+        only one page is ever in memory. Exactly the shipped rows are deleted.
+        """
+        headers = dict(self.headers, **{'Content-Encoding': 'gzip'}) if self.compress_logs else self.headers
+        for table, script in (('capture_logs', 'CAPTURE'), ('upload_logs', 'UPLOAD')):
+            cursor = 0
+            while True:
+                with self.db:
+                    rows = self.db.get_pending_page(table, cursor, self.log_page_size)
+                if not rows:
+                    break
+
+                body = json.dumps(format_logs(rows, script)).encode()
+                if self.compress_logs:
+                    body = gzip.compress(body)
+                try:
+                    response = requests.request("POST", self.logs_url, headers=headers, data=body, timeout=10)
+                except Exception:
+                    logging.warning(f'Error while uploading logs')
+                    return
+
+                if response.status_code != 201:
+                    logging.warning(f'Logs upload failed with status {response.status_code}')
+                    return
+
+                with self.db:
+                    self.db.delete_rows(table, [row[0] for row in rows])
+                cursor = rows[-1][0]
+                logging.info(f'Uploaded {len(rows)} {script.lower()} logs')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,41 @@
+"""
+Setup shared by the scripts that run the trap's code off the device,
+benchmark.py and replay.py.
+"""
+import os
+import tempfile
+
+ME = {
+    'description': 'Offline Trap', 'video_interval': 3, 'motion_interval': 3, 'rest_interval': 1,
+    'day_threshold': 500, 'night_threshold': 500, 'sunrise': '2020-01-01T06:00:00',
+    'sunset': '2020-01-01T18:00:00', 'update_after': 3600, 'last_reported_at': '2099-01-01T00:00:00',
+    'frames_per_sec': 30, 'pwm': 50, 'motion_1': 1, 'motion_2': 2, 'infrared': 3, 'filter_a': 4,
+    'filter_b': 5, 'live': True, 'should_log': False, 'roi_mask': None,
+}
+
+
+def setup_environment(name):
+    """
+    utils reads SITE/TOKEN at import time, call this before importing the
+    trap's modules. GPIO is simulated.
+    """
+    os.environ.setdefault('SITE', 'http://localhost')
+    os.environ.setdefault('TOKEN', name)
+    os.environ.setdefault('CAMERA_TRAP_GPIO', 'sim')
+
+
+def enter_workdir(name, workdir=None):
+    """
+    Changes into workdir, or a new temporary directory, where data_root will
+    be created. The trap's modules resolve data_root when they are imported,
+    so they must be imported after this.
+    :return: the previous working directory, where output files belong
+    """
+    output_cwd = os.getcwd()
+    os.chdir(workdir or tempfile.mkdtemp(prefix=f'camera_trap_{name}_'))
+    return output_cwd
+
+
+def trap_me(**overrides):
+    """A valid ME.json for offline runs, with overrides applied."""
+    return dict(ME, **overrides)
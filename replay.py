@@ -0,0 +1,272 @@
+"""
+Runs the capture pipeline offline against recorded footage.
+
+    python3 replay.py SOURCE [--me ME.json] [--fps 30] [--start 2021-06-01T12:00:00] [--output replay_output.json]
+
+SOURCE is a video file, an MJPEG file or stream URL, or an events/done
+directory (or a single event in it) of <millis>.jpg frames and containers.
+The real Capture.step() runs on it with a virtual clock following the frame
+timestamps, so day/night and the motion, video and rest intervals behave as
+they would on the trap, only faster than real time. Events are written to a
+scratch data_root. Decisions, throughput and per-stage timings are printed
+and written as JSON.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from container import EventContainer
+from offline import enter_workdir, setup_environment, trap_me
+
+setup_environment('replay')
+
+ME = trap_me(description='Replay Trap')
+
+
+class VirtualClock:
+    """Clock set from the timestamps of the replayed frames."""
+
+    def __init__(self, start=0.0):
+        self.current = start
+
+    def time(self):
+        return self.current
+
+    def millis(self):
+        return round(self.current * 1000)
+
+    def now(self):
+        return datetime.fromtimestamp(self.current)
+
+    def advance(self, seconds):
+        self.current += seconds
+
+    def set_millis(self, millis):
+        self.current = max(self.current, millis / 1000)
+
+
+def video_frames(source, start, fps=None):
+    """
+    Every frame of a video file or MJPEG file/stream, stamped start + its
+    position in the stream.
+    Sources yield (timestamp, load), load() decodes the frame and must be
+    called before the next one is taken, frames that aren't sampled are
+    never decoded.
+    """
+    camera = cv2.VideoCapture(source)
+    if not camera.isOpened():
+        raise IOError(f'Could not open {source}')
+    fps = fps or camera.get(cv2.CAP_PROP_FPS) or 30
+    index = 0
+    try:
+        while camera.grab():
+            yield start + round(index * 1000 / fps), lambda: camera.retrieve()[1]
+            index += 1
+    finally:
+        camera.release()
+
+
+def directory_frames(path):
+    """
+    The frames of an events or done directory, or of one event in it, in
+    timestamp order. Frames are already sampled, one file per frame.
+    """
+    if os.path.isfile(path) or any(name.endswith('.jpg') for name in os.listdir(path)):
+        entries = [path]
+    else:
+        entries = [os.path.join(path, name) for name in os.listdir(path)]
+
+    frames = []
+    for entry in entries:
+        if EventContainer.is_container(entry):
+            container = EventContainer(entry)
+            frames += [(int(item[:-4]), (container, item)) for item in container.index]
+        elif os.path.isdir(entry):
+            frames += [(int(name[:-4]), os.path.join(entry, name)) for name in os.listdir(entry)
+                       if name.endswith('.jpg')]
+
+    for timestamp, location in sorted(frames, key=lambda f: f[0]):
+        yield timestamp, lambda location=location: load_frame(location)
+
+
+def load_frame(location):
+    if isinstance(location, tuple):
+        container, item = location
+        return cv2.imdecode(np.frombuffer(container.read(item), np.uint8), cv2.IMREAD_COLOR)
+    return cv2.imread(location)
+
+
+class ReplayGrabber:
+    """
+    Stands in for FrameGrabber, handing out the recorded frames in order.
+    Like the real grabber only every sample_every-th frame is sampled, and
+    frames from before the clock (the camera kept running while the
+    pipeline was idle) are dropped.
+    """
+
+    def __init__(self, frames, clock, ring_class, sample_every=1, capacity=16, presampled=False):
+        self.frames = frames
+        self.clock = clock
+        self.sample_every = sample_every
+        self.presampled = presampled
+        self.ring_class = ring_class
+        self.ring = ring_class(capacity)
+        self.capacity = capacity
+        self.read_count = 0
+        self.decode_time = 0
+
+    def read(self, timeout=5):
+        skipped = 0
+        for timestamp, load in self.frames:
+            if timestamp < self.clock.millis():
+                continue
+            skipped += 1
+            if not self.presampled and skipped < self.sample_every:
+                continue
+
+            start = time.perf_counter()
+            frame = load()
+            self.decode_time += time.perf_counter() - start
+            if frame is None:
+                continue
+
+            if self.ring.frames is None or self.ring.frames.shape[1:] != frame.shape or \
+                    self.ring.capacity != self.capacity:
+                self.ring = self.ring_class(self.capacity)
+                self.ring.allocate(frame.shape)
+            np.copyto(self.ring.next_slot(), frame)
+            self.clock.set_millis(timestamp)
+            self.read_count += 1
+            return timestamp, self.ring.commit(timestamp)
+        return None, None
+
+    def recent(self, start, end):
+        return self.ring.between(start, end)
+
+    def ensure_capacity(self, capacity):
+        self.capacity = max(self.capacity, capacity)
+
+    def pause(self):
+        pass
+
+    def resume(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays recorded footage through the capture pipeline')
+    parser.add_argument('source', help='video file, MJPEG file or URL, or an events/done directory')
+    parser.add_argument('--me', help='ME.json to run with, a day time default is used otherwise')
+    parser.add_argument('--fps', type=float, help='frame rate of the video, read from the file by default')
+    parser.add_argument('--start', help='wall clock time of the first video frame, e.g. 2021-06-01T12:00:00')
+    parser.add_argument('--workdir', help='where data_root is created, a temporary directory by default')
+    parser.add_argument('--output', default='replay_output.json')
+    args = parser.parse_args()
+
+    source = os.path.abspath(args.source) if os.path.exists(args.source) else args.source
+    me = ME
+    if args.me:
+        with open(args.me, 'r') as file:
+            me = json.loads(file.read())
+    output_cwd = enter_workdir('replay', args.workdir)
+
+    # Imported once in the scratch directory, data_root is resolved at import time
+    from capture import Capture
+    from grabber import FrameRing
+    from metrics import Metrics
+    from utils import Constants, dt_parse
+
+    os.makedirs(Constants.data_dir, exist_ok=True)
+    Constants().write_params(me)
+
+    if os.path.isdir(source):
+        frames = list(directory_frames(source))
+        if not frames:
+            raise SystemExit(f'No frames found in {source}')
+        start = frames[0][0]
+        frames = iter(frames)
+        presampled = True
+    else:
+        start_dt = dt_parse(args.start) if args.start else datetime.now().replace(hour=12, minute=0, second=0)
+        start = round(start_dt.timestamp() * 1000)
+        frames = video_frames(source, start, args.fps)
+        presampled = False
+
+    class ReplayCapture(Capture):
+        metrics_name = None
+
+        def idle(self, signal=None, timeout=None):
+            # Frames recorded while the trap would have waited are skipped
+            self.clock.advance(timeout or 0)
+
+    clock = VirtualClock(start / 1000)
+    capture = ReplayCapture()
+    capture.clock = clock
+    # There are no PIR recordings, every window goes through motion detection
+    capture.config.trigger_mode = 'continuous'
+    capture.config.live = True
+    capture.grabber = ReplayGrabber(frames, clock, FrameRing, sample_every=capture.frames_per_sec,
+                                    capacity=capture.ring_capacity, presampled=presampled)
+
+    decisions = []
+    wall_start = time.perf_counter()
+    while True:
+        window_start = clock.millis()
+        try:
+            decision = capture.step()
+        except RuntimeError:
+            # Out of frames
+            break
+        if decision is None:
+            continue
+        is_motion, contours = decision
+        decisions.append({
+            'at': datetime.fromtimestamp(window_start / 1000).strftime('%Y-%m-%dT%H:%M:%S'),
+            'motion': is_motion,
+            'contours': contours,
+            'event': capture.event_id if is_motion else None,
+            'sunlight': capture.is_sunlight(),
+        })
+        logging.info(f'{decisions[-1]}')
+    capture.writer.flush()
+    wall_time = time.perf_counter() - wall_start
+
+    footage_time = max(clock.millis() - start, 1) / 1000
+    report = {
+        'source': source,
+        'data_root': Constants.data_dir,
+        'frames': capture.grabber.read_count,
+        'windows': len(decisions),
+        'events': len(set(d['event'] for d in decisions if d['event'])),
+        'wall_seconds': round(wall_time, 3),
+        'footage_seconds': round(footage_time, 3),
+        'speedup': round(footage_time / wall_time, 2),
+        'fps': round(capture.grabber.read_count / wall_time, 2),
+        'decode_seconds': round(capture.grabber.decode_time, 3),
+        'stages': Metrics.summarize(capture.metrics.snapshot()),
+        'decisions': decisions,
+    }
+    output = os.path.join(output_cwd, args.output)
+    with open(output, 'w') as file:
+        file.write(json.dumps(report, indent=4))
+
+    print(f"{report['frames']} frames, {report['windows']} windows, {report['events']} events")
+    print(f"{report['fps']} fps, {report['speedup']}x real time, decoding took {report['decode_seconds']}s")
+    for name, stage in report['stages'].items():
+        if isinstance(stage, dict):
+            print(f'{name:25} ' + ' '.join(f'{k}={v}' for k, v in stage.items()))
+    print(f'Written to {output}')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - replay:%(levelname)s - %(message)s', level=logging.WARNING)
+    main()
@@ -0,0 +1,126 @@
+import logging
+import os
+import shutil
+import time
+
+import psutil
+
+
+class StorageManager:
+    """
+    Size index of the data directories, one entry per event (a directory of
+    jpgs or a container) or temp file. An entry is only walked again when its
+    mtime changed, a refresh is one listdir and one stat per entry.
+    enforce() keeps done_dir within its quota and the disk above min_free by
+    deleting the oldest uploaded events, it is only run by the uploader.
+    pressure() tells capture how hard to back off once that is not enough:
+    'ok', 'reduce' or 'stop'.
+    """
+    TEMP_MAX_AGE = 3600
+    MB = 1024 * 1024
+
+    def __init__(self, events_dir, done_dir, temp_dir):
+        self.directories = {'events': events_dir, 'done': done_dir, 'temp': temp_dir}
+        # name -> {entry: (mtime_ns, bytes)}
+        self.index = {name: {} for name in self.directories}
+
+    @staticmethod
+    def entry_size(path):
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+        total = 0
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    total += entry.stat().st_size
+        return total
+
+    def refresh(self, name):
+        path = self.directories[name]
+        index = self.index[name]
+        seen = set()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    mtime = entry.stat().st_mtime_ns
+                    cached = index.get(entry.name)
+                    if cached is None or cached[0] != mtime:
+                        index[entry.name] = (mtime, self.entry_size(entry.path))
+                    seen.add(entry.name)
+                except FileNotFoundError:
+                    # Moved away by the other script while walking
+                    pass
+        for gone in set(index) - seen:
+            del index[gone]
+
+    def size(self, name):
+        return sum(size for _, size in self.index[name].values())
+
+    def free_space(self):
+        return psutil.disk_usage(self.directories['done']).free
+
+    def remove(self, name, entry):
+        path = os.path.join(self.directories[name], entry)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.index[name].pop(entry, None)
+
+    def evict_done(self, done_quota, min_free):
+        """
+        Deletes the oldest uploaded events until done_dir is within done_quota
+        (0 is no quota) and at least min_free bytes are free.
+        :return: number of events deleted
+        """
+        done = sorted(self.index['done'].items(), key=lambda item: item[1][0])
+        size = self.size('done')
+        free = self.free_space()
+        evicted = 0
+        for entry, (_, entry_size) in done:
+            if (not done_quota or size <= done_quota) and free >= min_free:
+                break
+            self.remove('done', entry)
+            size -= entry_size
+            free += entry_size
+            evicted += 1
+        return evicted
+
+    def clean_temp(self):
+        # Frames are renamed out of temp_dir right after they are written,
+        # anything old was left behind by a crash
+        cutoff = (time.time() - self.TEMP_MAX_AGE) * 1e9
+        for entry, (mtime, _) in list(self.index['temp'].items()):
+            if mtime < cutoff:
+                self.remove('temp', entry)
+
+    def enforce(self, done_quota=0, events_quota=0, min_free=0):
+        """
+        Quotas and min_free in bytes, 0 means no limit.
+        :return: the storage pressure after eviction, see pressure()
+        """
+        for name in self.directories:
+            self.refresh(name)
+        self.clean_temp()
+
+        evicted = self.evict_done(done_quota, min_free)
+        if evicted:
+            logging.info(f'Deleted {evicted} uploaded events to free space')
+        return self.pressure(events_quota, min_free)
+
+    def pressure(self, events_quota=0, min_free=0):
+        """
+        From the events_dir index as of its last refresh and the free space.
+        :return: 'ok', 'reduce' when un-uploaded events are getting close to
+            their limits, 'stop' when nothing more should be written
+        """
+        events = self.size('events')
+        free = self.free_space()
+        if free < min_free or (events_quota and events > events_quota):
+            return 'stop'
+        if free < 2 * min_free or (events_quota and events > 0.8 * events_quota):
+            return 'reduce'
+        return 'ok'
@@ -1,108 +1,398 @@
 import os
+import random
 import shutil
 import logging
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 
 import cv2
 import requests
 
-from utils import Constants
-from utils import ImageOperations
+from container import EventContainer
+from storage import StorageManager
+from utils import Constants, WorkSignal, current_milli_time
+from utils import FooterRenderer, ImageOperations
+
+
+class CircuitBreaker:
+    """
+    Pauses all uploads once `threshold` uploads in a row could not reach the
+    server. After the cooldown a single probe upload is let through, success
+    closes the breaker and failure opens it again for twice as long.
+    """
+
+    def __init__(self, threshold=5, cooldown=30, max_cooldown=1800):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.open_until is not None
+
+    @property
+    def probing(self):
+        return self.is_open and time.time() >= self.open_until
+
+    def wait_time(self):
+        if not self.is_open:
+            return 0
+        return max(0, self.open_until - time.time())
+
+    def success(self):
+        """
+        :return: True if this closed an open breaker
+        """
+        with self.lock:
+            was_open = self.is_open
+            self.failures = 0
+            self.cooldown = self.base_cooldown
+            self.open_until = None
+            return was_open
+
+    def failure(self):
+        """
+        :return: True if this opened the breaker
+        """
+        with self.lock:
+            self.failures += 1
+            if self.is_open and time.time() < self.open_until:
+                # Uploads that were already in flight when it opened
+                return False
+            if self.is_open:
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            elif self.failures < self.threshold:
+                return False
+            self.open_until = time.time() + self.cooldown
+            return True
+
+
+class ByteBudget:
+    """
+    Token bucket limiting uploads to bytes_per_hour, 0 means unlimited.
+    An image is let through whenever the bucket isn't empty and may take it
+    below zero, the debt is paid back before the next one.
+    """
+
+    def __init__(self, bytes_per_hour=0):
+        self.bytes_per_hour = None
+        self.lock = threading.Lock()
+        self.set_rate(bytes_per_hour)
+
+    def set_rate(self, bytes_per_hour):
+        if bytes_per_hour == self.bytes_per_hour:
+            return
+        self.bytes_per_hour = bytes_per_hour
+        # Bursts of at most a minute's worth of budget
+        self.capacity = bytes_per_hour / 60
+        self.tokens = self.capacity
+        self.updated = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.bytes_per_hour / 3600)
+        self.updated = now
+
+    def wait_time(self):
+        if not self.bytes_per_hour:
+            return 0
+        with self.lock:
+            self.refill()
+            return 0 if self.tokens > 0 else -self.tokens * 3600 / self.bytes_per_hour
+
+    def acquire(self, size):
+        if not self.bytes_per_hour:
+            return True
+        with self.lock:
+            self.refill()
+            if self.tokens <= 0:
+                return False
+            self.tokens -= size
+            return True
 
 
 class UploadManager(Constants):
     table = 'upload_logs'
+    metrics_name = 'upload'
+    reconcile_interval = 3600
+    finish_grace = 60
 
     def __init__(self):
         super().__init__()
+        self.containers = {}
+        self.container_lock = threading.Lock()
+        self.sessions = threading.local()
+        self.footer = FooterRenderer()
+        self.breaker = CircuitBreaker()
         logging.info('Script Started')
         self.read_params()
+        self.budget = ByteBudget(self.upload_budget)
+        self.pool_size = self.upload_workers
+        self.pool = ThreadPoolExecutor(max_workers=self.pool_size)
+        # future -> (event, item) of the uploads running on the pool
+        self.in_flight = {}
 
         with self.db:
             self.db.create_tables()
 
         logging.info(f'Checked Tables')
-        self.put_log([f'"{datetime.now().strftime("%Y-%m-%dT%H:%M:%S")}"', '"SCRIPT_STARTED"', '1', f'"Upload Started"'])
+        # Frames written without their queue row (capture died or the insert
+        # failed) are picked up here, already queued ones are ignored
+        self.rebuild_queue()
+        self.scheduler.every(self.reconcile_interval, self.rebuild_queue)
+        # Uploaded events waiting for capture to stop recording them
+        self.uploaded = set()
+        self.scheduler.every(self.finish_grace, self.finish_events)
+
+        self.upload_signal = WorkSignal(self.upload_fifo)
+        self.put_log('SCRIPT_STARTED', 'Upload Started')
+        self.scheduler.every(lambda: self.update_after, self.heartbeat)
+        # Uploaded events end up in done_dir, keep it within its quota
+        self.storage = StorageManager(self.events_dir, self.done_dir, self.temp_dir)
+        self.scheduler.every(self.storage_interval, self.enforce_storage, start_now=True)
+
+    def heartbeat(self):
+        self.put_log('ALIVE', 'Upload Alive')
 
     def run(self):
         while True:
-            if self.params_expired:
-                self.read_params()
-                if self.logging:
-                    self.put_log([f'"{datetime.now().strftime("%Y-%m-%dT%H:%M:%S")}"',
-                                   '"ALIVE"', '1', f'"Upload Alive"'])
-                    self.logging = False
-            else:
-                self.logging = True
-
-            events = os.listdir(self.events_dir)
-            if not events:
-                time.sleep(1)
-            else:
-                event = sorted(events, key=lambda e: os.stat(os.path.join(self.events_dir, e)).st_ctime, reverse=True)[0]
-                items = os.listdir(os.path.join(self.events_dir, event))
-                if items:
-                    item = items[0]
-                    temp_img_path = self.prepare_image(event, item, width=640, height=480)
-                    if not temp_img_path:
-                        self.put_log([f'"{datetime.now().strftime("%Y-%m-%dT%H:%M:%S")}"',
-                                      '"UPLOAD_FAILED"', '1', f'"Corrupted image found! UUID: {event}"'])
-                        self.move_to_done(event, item)
-                    elif self.send_image(event, item, temp_img_path):
-                        self.move_to_done(event, item)
-
-                    if temp_img_path:
-                        os.remove(os.path.join(self.temp_dir, item))
+            self.scheduler.run_pending()
+            self.budget.set_rate(self.upload_budget)
+            wait = max(self.breaker.wait_time(), self.budget.wait_time())
+            if wait > 0:
+                if self.in_flight:
+                    self.collect(timeout=wait)
                 else:
-                    shutil.rmtree(os.path.join(self.events_dir, event))
+                    self.scheduler.wait(timeout=wait)
+                continue
+
+            # While the breaker is half open a single image probes the server
+            free = (1 if self.breaker.probing else self.pool_size) - len(self.in_flight)
+            work = []
+            if free > 0:
+                with self.db:
+                    # Rows stay queued while they upload, skip the ones in flight
+                    rows = self.db.dequeue(free + len(self.in_flight), current_milli_time())
+                    work = [row for row in rows if row[:2] not in self.in_flight.values()][:free]
+                    next_due = None if rows else self.db.next_due()
+
+            # Keep up to upload_workers images in flight, a new one starts as
+            # soon as any of them is done
+            for event, item, attempts in work:
+                self.in_flight[self.pool.submit(self.upload_item, event, item, attempts)] = (event, item)
+
+            if self.in_flight:
+                self.collect(timeout=self.scheduler.time_to_next())
+            elif not work:
+                # Sleeps until new work, the next retry or the next heartbeat
+                timeout = None if next_due is None else max(0, next_due - current_milli_time()) / 1000
+                self.scheduler.wait(self.upload_signal, timeout=timeout)
+
+    def collect(self, timeout=None):
+        """
+        Waits for at least one upload in flight to finish, or timeout.
+        """
+        done, _ = wait(self.in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            event, _ = self.in_flight.pop(future)
+            self.uploaded.add(event)
+            try:
+                future.result()
+            except Exception:
+                logging.exception(f'Error while uploading an image of {event}')
+
+    def drain(self):
+        while self.in_flight:
+            self.collect()
+
+    def flush_metrics(self):
+        with self.db:
+            self.metrics.gauge('queue_depth', self.db.queue_size())
+        super().flush_metrics()
+
+    def rebuild_queue(self):
+        """
+        Queues every frame still in events_dir that isn't queued yet, run on
+        start and every reconcile_interval seconds.
+        """
+        # A frame moved to done_dir after the listing would be queued again
+        self.drain()
+        rows = []
+        for event in os.listdir(self.events_dir):
+            items = self.list_items(event)
+            if items:
+                created = min(int(item[:-4]) for item in items)
+                rows += [(event, item, created) for item in items]
+            elif self.recording_over(event):
+                # Everything was uploaded but the event was never finished
+                self.finish_event(event)
+
+        with self.db:
+            added = self.db.enqueue(rows)
+        if added:
+            logging.info(f'Queued {added} images missing from the upload queue')
+
+    def recording_over(self, event):
+        """
+        Capture keeps adding frames to an event for video_interval seconds
+        after the last motion, it is done once nothing was written for longer
+        than that plus a window and finish_grace.
+        """
+        quiet = time.time() - os.path.getmtime(os.path.join(self.events_dir, event))
+        return quiet > self.video_interval + self.motion_interval + self.finish_grace
+
+    def finish_events(self):
+        for event in list(self.uploaded):
+            if not os.path.exists(os.path.join(self.events_dir, event)):
+                self.uploaded.discard(event)
+            elif self.list_items(event):
+                # New frames came in, they are queued by capture
+                self.uploaded.discard(event)
+            elif self.recording_over(event):
+                self.finish_event(event)
+                self.uploaded.discard(event)
+
+    @property
+    def session(self):
+        # One keep-alive session per worker thread, the TLS connection is reused between images
+        if not hasattr(self.sessions, 'session'):
+            self.sessions.session = requests.Session()
+            self.sessions.session.headers.update(self.headers_im)
+        return self.sessions.session
 
-    def send_image(self, event, item, temp_path):
+    def upload_item(self, event, item, attempts=0):
+        image = self.prepare_image(event, item, width=640, height=480)
+        if image is None:
+            self.put_log('UPLOAD_FAILED', f'Corrupted image found! UUID: {event}')
+            self.move_to_done(event, item)
+        elif not self.budget.acquire(len(image)):
+            # Over the bandwidth budget, the image stays queued as it is
+            return
+        elif self.send_image(event, item, image):
+            self.move_to_done(event, item)
+        else:
+            self.defer(event, item, attempts)
+
+    def defer(self, event, item, attempts):
+        # Exponential backoff with jitter, 10s doubling up to an hour
+        delay = min(10 * 2 ** attempts, 3600) * random.uniform(0.5, 1.5)
+        with self.db:
+            self.db.defer(event, item, current_milli_time() + int(delay * 1000))
+
+    def send_image(self, event, item, image):
         file_dt = datetime.fromtimestamp(float(item[:-4]) / 1000)
-        payload = {'uuid': event, 'date': str(file_dt)}
-        files = [('file', (item, open(temp_path, 'rb'), 'image/jpg'))]
+        uuid = os.path.splitext(event)[0]
+        payload = {'uuid': uuid, 'date': str(file_dt)}
+        files = [('file', (item, image, 'image/jpg'))]
         try:
-            response = requests.request("POST", self.image_url, headers=self.headers_im, data=payload, files=files)
+            with self.metrics.timer('upload_ms'):
+                response = self.session.post(self.image_url, data=payload, files=files, timeout=self.upload_timeout)
+            if response.status_code >= 500:
+                self.server_unreachable()
+            elif self.breaker.success():
+                # Connectivity is back, retry everything newest first instead of waiting out the backoffs
+                with self.db:
+                    self.db.clear_backoff()
+                logging.info('Server reachable again, uploads resumed')
+
             if response.status_code in [201, 208]:
-                self.put_log([f'"{datetime.now().strftime("%Y-%m-%dT%H:%M:%S")}"',
-                              '"UPLOAD_SUCCESS"', '1', f'"UUID: {event} & Image At: {file_dt}"'])
+                self.metrics.count('uploads')
+                self.metrics.count('upload_bytes', len(image))
+                self.put_log('UPLOAD_SUCCESS', f'UUID: {uuid} & Image At: {file_dt}')
                 logging.info(f'Successfully Uploaded Image At: {file_dt}')
                 return True
         except Exception as e:
             logging.info(f'Could not upload image: {file_dt}')
-            pass
+            self.server_unreachable()
 
-        self.put_log([f'"{datetime.now().strftime("%Y-%m-%dT%H:%M:%S")}"',
-                      '"UPLOAD_FAILED"', '1', f'"UUID: {event} & Image At: {file_dt}"'])
+        self.metrics.count('upload_failures')
+        self.put_log('UPLOAD_FAILED', f'UUID: {uuid} & Image At: {file_dt}')
 
         return False
 
+    def server_unreachable(self):
+        if self.breaker.failure():
+            logging.warning(f'Server unreachable, uploads paused for {self.breaker.cooldown}s')
+            self.put_log('UPLOAD_PAUSED', f'Server unreachable, retrying in {self.breaker.cooldown}s')
+
+    def get_container(self, event):
+        with self.container_lock:
+            container = self.containers.get(event)
+            if container is None:
+                container = self.containers[event] = EventContainer(os.path.join(self.events_dir, event))
+            else:
+                container.refresh()
+            return container
+
+    def list_items(self, event):
+        if EventContainer.is_container(event):
+            return self.get_container(event).pending()
+        return os.listdir(os.path.join(self.events_dir, event))
+
+    def finish_event(self, event):
+        if EventContainer.is_container(event):
+            self.get_container(event).move_to(os.path.join(self.done_dir, event))
+            self.containers.pop(event)
+        else:
+            shutil.rmtree(os.path.join(self.events_dir, event))
+
     def move_to_done(self, event, item):
+        with self.db:
+            self.db.remove_queued(event, item)
+
+        if EventContainer.is_container(event):
+            container = self.get_container(event)
+            if item in container.index:
+                container.mark_done(item)
+            return
+
         item_path = os.path.join(self.events_dir, event, item)
+        if not os.path.exists(item_path):
+            return
         done_item_path = os.path.join(self.done_dir, event)
-        if not os.path.exists(done_item_path):
-            os.makedirs(done_item_path)
+        os.makedirs(done_item_path, exist_ok=True)
         shutil.move(item_path, os.path.join(done_item_path, item))
 
-    def get_copy_rights(self, file_dt):
-        long_txt = file_dt.strftime('%b %d, %Y     %H:%M:%S') + '     ' + self.name + '     ' + 'POWERED BY LUMS'
-        shrt_txt = file_dt.strftime('%d.%m.%y  %H:%M') + '  ' + "".join(e[0] for e in self.name.split()) + '  LUMS'
-        return shrt_txt, long_txt
+    def read_image(self, event, item):
+        if EventContainer.is_container(event):
+            container = self.get_container(event)
+            if item not in container.index:
+                return None
+            return container.read(item)
+
+        try:
+            with open(os.path.join(self.events_dir, event, item), 'rb') as file:
+                return file.read()
+        except IOError:
+            return None
 
     def prepare_image(self, event, item, width, height):
-        item_path = os.path.join(self.events_dir, event, item)
+        """
+        Decodes, resizes and stamps the image and returns it encoded as jpg
+        bytes, nothing is written to disk.
+        """
         file_dt = datetime.fromtimestamp(float(item[:-4]) / 1000)
-        im = cv2.imread(item_path)
+        data = self.read_image(event, item)
+        if data is None:
+            return None
+
+        im = ImageOperations.decode_reduced(data, width, height)
         if im is None:
             return None
 
-        short_txt, long_txt = self.get_copy_rights(file_dt)
-        im = ImageOperations.addFooter(im, short_txt, long_txt)
-        temp_item_path = os.path.join(self.temp_dir, item)
-        file, ext = os.path.splitext(temp_item_path)
-        im_resize = cv2.resize(im, (width, height))
-        cv2.imwrite(file + '.jpg', im_resize, [cv2.IMWRITE_JPEG_QUALITY, 90])
-        return temp_item_path
+        # Resize first, so the footer is drawn on the smaller image
+        im = cv2.resize(im, (width, height))
+        im = self.footer.draw(im, file_dt, self.name)
+        ret_val, buffer = cv2.imencode('.jpg', im, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        if not ret_val:
+            return None
+        return buffer.tobytes()
 
 
 if __name__ == "__main__":
@@ -2,6 +2,7 @@ import json
 import logging
 import math
 import os
+import select
 import time
 from datetime import datetime, timedelta
 
@@ -9,7 +10,8 @@ import cv2
 import numpy as np
 import psutil
 
-from data_link_layer import SQLite
+from data_link_layer import BufferedWriter, SQLite
+from metrics import Metrics
 
 
 def gstreamer_pipeline(capture_width=1280, capture_height=720,
@@ -84,12 +86,19 @@ class ImageOperations:
         return _result
 
     @staticmethod
-    def error_image_gray_histmatch(im1, im2, invert=False):
+    def error_image_gray_histmatch(im1, im2, invert=False, matcher=None):
+        """
+        Difference of two images after matching the histogram of im2 to im1.
+        Pass a HistogramMatcher built on im1 to reuse its reference cdf when
+        im1 is compared against many frames.
+        """
         im1_gray = ImageOperations.convert_image_to_gray(im1)
         im2_gray = ImageOperations.convert_image_to_gray(im2)
 
-        im2_gray = ImageOperations.match_histograms(im2_gray, im1_gray)
-        _result = cv2.absdiff(im1_gray, im2_gray.astype(np.uint8))
+        if matcher is None:
+            matcher = HistogramMatcher(im1_gray)
+        im2_gray = matcher.match(im2_gray)
+        _result = cv2.absdiff(im1_gray, im2_gray)
         _result = cv2.normalize(_result, dst=None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_8U)
         if invert:
             _result = 255 - _result
@@ -98,7 +107,6 @@ class ImageOperations:
     @staticmethod
     def match_histograms(src_image, ref_image):
         """
-        This implementation is 3x slower than that of scikit image
         This method matches the source image histogram to the
         reference signal
         :param image src_image: The original source image
@@ -106,32 +114,7 @@ class ImageOperations:
         :return: image_after_matching
         :rtype: image (array)
         """
-
-        # Compute the histograms separately
-        # The flatten() Numpy method returns a copy of the array c
-        # collapsed into one dimension.
-        src_hist, bin_0 = np.histogram(src_image.flatten(), 256, [0, 256])
-        ref_hist, bin_3 = np.histogram(ref_image.flatten(), 256, [0, 256])
-
-        # Compute the normalized cdf for the source and reference image
-        # Get the cumulative sum of the elements
-        src_cdf = src_hist.cumsum()
-        ref_cdf = ref_hist.cumsum()
-
-        # Normalize the cdf
-        src_cdf = src_cdf / float(src_cdf.max())
-        ref_cdf = ref_cdf / float(ref_cdf.max())
-
-        # Make a separate lookup table for each color
-        lookup_table = ImageOperations.calculate_lookup(src_cdf, ref_cdf)
-
-        # Use the lookup function to transform the colors of the original
-        # source image
-        image_after_matching = cv2.LUT(src_image, lookup_table)
-
-        # image_after_matching = cv2.convertScaleAbs(image_after_matching)
-
-        return image_after_matching
+        return HistogramMatcher(ref_image).match(src_image)
 
     @staticmethod
     def calculate_lookup(src_cdf, ref_cdf):
@@ -142,16 +125,10 @@ class ImageOperations:
         :return: lookup_table: The lookup table
         :rtype: array
         """
-        lookup_table = np.zeros(256)
-        lookup_val = 0
-        for src_pixel_val in range(len(src_cdf)):
-            lookup_val
-            for ref_pixel_val in range(len(ref_cdf)):
-                if ref_cdf[ref_pixel_val] >= src_cdf[src_pixel_val]:
-                    lookup_val = ref_pixel_val
-                    break
-            lookup_table[src_pixel_val] = lookup_val
-        return lookup_table
+        # For every source level pick the first reference level whose cdf
+        # reaches the source cdf, same as the nested loop it replaces.
+        lookup_table = np.searchsorted(ref_cdf, src_cdf, side='left')
+        return np.minimum(lookup_table, 255).astype(np.uint8)
 
     @staticmethod
     def gamma_correction(image):
@@ -196,6 +173,43 @@ class ImageOperations:
         change = (np.sum(image) / 255) / (image_width * image_height) * 100
         return change
 
+    @staticmethod
+    def jpeg_size(data):
+        """
+        Reads (width, height) from the SOF header of a jpg without decoding it
+        :return: (width, height) or None if no SOF header was found
+        """
+        i = 2
+        while i + 9 < len(data):
+            if data[i] != 0xFF:
+                return None
+            marker = data[i + 1]
+            if marker == 0xFF:
+                i += 1
+                continue
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height = (data[i + 5] << 8) | data[i + 6]
+                width = (data[i + 7] << 8) | data[i + 8]
+                return width, height
+            i += 2 + ((data[i + 2] << 8) | data[i + 3])
+        return None
+
+    @staticmethod
+    def decode_reduced(data, width, height):
+        """
+        Decodes jpg bytes at the smallest of 1/8, 1/4, 1/2 or full scale that
+        is still at least width x height, libjpeg skips the rest of the work.
+        """
+        flag = cv2.IMREAD_COLOR
+        size = ImageOperations.jpeg_size(data)
+        if size is not None:
+            for factor, reduced_flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                         (2, cv2.IMREAD_REDUCED_COLOR_2)):
+                if size[0] // factor >= width and size[1] // factor >= height:
+                    flag = reduced_flag
+                    break
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+
     @staticmethod
     def get_optimal_font_scale(text, height, width, argfontFace, argthickness):
         for scale in reversed(range(0, 60, 1)):
@@ -241,6 +255,460 @@ class ImageOperations:
         return cv2.putText(img, txtstr, org, font, fontScale, color, thickness, cv2.LINE_AA)
 
 
+class FooterRenderer:
+    """
+    Draws the footer of uploaded images, same layout as ImageOperations.addFooter.
+    The bar layout and font scale are worked out once per (resolution, camera
+    name) and the static part of the text (camera name, POWERED BY LUMS) is
+    rendered once into an overlay, only the timestamp is drawn per image.
+    """
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    thickness = 1
+    color = (255, 255, 255)
+
+    def __init__(self):
+        self.layouts = {}
+
+    @staticmethod
+    def texts(file_dt, name):
+        """
+        :return: ((short timestamp, short static text), (long timestamp, long static text))
+        """
+        short_txt = (file_dt.strftime('%d.%m.%y  %H:%M'), '  ' + "".join(e[0] for e in name.split()) + '  LUMS')
+        long_txt = (file_dt.strftime('%b %d, %Y     %H:%M:%S'), '     ' + name + '     ' + 'POWERED BY LUMS')
+        return short_txt, long_txt
+
+    def layout(self, img, file_dt, name):
+        height, width = img.shape[:2]
+        channels = img.shape[2] if len(img.shape) == 3 else 1
+        key = (width, height, channels, name)
+        if key not in self.layouts:
+            self.layouts[key] = self.build_layout(width, height, channels, file_dt, name)
+        return self.layouts[key]
+
+    def build_layout(self, width, height, channels, file_dt, name):
+        short_txt, long_txt = self.texts(file_dt, name)
+        row = int(math.ceil(height * 0.95))  # Hardcoded to 0.95 based on exprical evidence
+        short = height - row < 11  # Hardcoded to 11 based on exprical evidence
+        if short:
+            row = height - 11
+        textbar_height = height - row
+        stamp, static = short_txt if short else long_txt
+
+        # The timestamp always has the same format, the scale found for the
+        # first image fits the following ones
+        font_scale = ImageOperations.get_optimal_font_scale(stamp + static, textbar_height, width,
+                                                            self.font, self.thickness)
+        baseline = int(math.ceil(height - 0.3 * textbar_height))
+
+        static_width = cv2.getTextSize(static, self.font, font_scale, self.thickness)[0][0] + 2
+        overlay = np.zeros((textbar_height, min(static_width, width)) + ((channels,) if channels > 1 else ()), np.uint8)
+        cv2.putText(overlay, static, (0, baseline - row), self.font, font_scale, self.color, self.thickness, cv2.LINE_AA)
+        return short, row, baseline, font_scale, overlay
+
+    def draw(self, img, file_dt, name):
+        height, width = img.shape[:2]
+        short, row, baseline, font_scale, overlay = self.layout(img, file_dt, name)
+        stamp = self.texts(file_dt, name)[0 if short else 1][0]
+
+        img[row:height, 0:width] = 0
+        cv2.putText(img, stamp, (2, baseline), self.font, font_scale, self.color, self.thickness, cv2.LINE_AA)
+
+        x = 2 + cv2.getTextSize(stamp, self.font, font_scale, self.thickness)[0][0]
+        if x < width:
+            region = img[row:height, x:x + overlay.shape[1]]
+            cv2.max(region, overlay[:, :region.shape[1]], dst=region)
+        return img
+
+
+class HistogramMatcher:
+    """
+    Histogram matching against a fixed reference image.
+    The reference cdf is computed once, so a motion window only pays for the
+    source histogram and a 256 entry lookup per frame.
+    """
+
+    def __init__(self, ref_image=None):
+        self.ref_cdf = None
+        if ref_image is not None:
+            self.set_reference(ref_image)
+
+    @staticmethod
+    def cdf(image):
+        # calcHist works on the image in place, no flattened copy is made
+        hist = cv2.calcHist([image], [0], None, [256], [0, 256]).ravel()
+        cdf = hist.cumsum(dtype=np.float64)
+        return cdf / cdf[-1]
+
+    def set_reference(self, ref_image):
+        self.ref_cdf = self.cdf(ref_image)
+
+    def lookup(self, src_image):
+        return ImageOperations.calculate_lookup(self.cdf(src_image), self.ref_cdf)
+
+    def match(self, src_image):
+        return cv2.LUT(src_image, self.lookup(src_image))
+
+    def match_batch(self, src_images):
+        return [self.match(src_image) for src_image in src_images]
+
+
+class MotionDetector:
+    """
+    Base class of the motion detectors used by Capture.
+    apply() takes a frame and returns the area of the largest moving contour,
+    subclasses only decide how the foreground mask is computed.
+    With scale < 1 the whole chain runs on a downscaled copy of the frame and
+    areas are in downscaled pixels, refine() redoes the last frame at full size.
+    compared is False when the last frame had nothing to be compared with yet
+    (a reference or warmup frame), its area of 0 says nothing about the scene.
+    """
+
+    def __init__(self, mask=None, scale=1.0):
+        self.mask = mask
+        self.scale = scale
+        self.coarse_mask = None
+        self.gray = None
+        self.compared = False
+
+    def start_window(self):
+        pass
+
+    def reset(self):
+        pass
+
+    def foreground(self, gray):
+        raise NotImplementedError
+
+    def refine(self):
+        return None
+
+    def downscale(self, gray):
+        if self.scale >= 1:
+            return gray
+        return cv2.resize(gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+
+    def apply(self, frame):
+        self.gray = ImageOperations.convert_image_to_gray(frame)
+        small = self.downscale(self.gray)
+        diff = self.foreground(small)
+        self.compared = diff is not None
+        if small is self.gray:
+            return self.max_contour(diff, self.mask)
+
+        if self.mask is not None and (self.coarse_mask is None or self.coarse_mask.shape != small.shape):
+            self.coarse_mask = cv2.resize(self.mask, (small.shape[1], small.shape[0]),
+                                          interpolation=cv2.INTER_NEAREST)
+        return self.max_contour(diff, self.coarse_mask)
+
+    @staticmethod
+    def max_contour(diff, mask=None):
+        if diff is None:
+            return 0
+        if mask is not None:
+            diff = cv2.bitwise_and(diff, diff, mask=mask)
+        diff = cv2.erode(diff, None, iterations=1)
+        diff = cv2.dilate(diff, None, iterations=3)
+        cnts, _ = cv2.findContours(diff, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        return max([cv2.contourArea(cnt) for cnt in cnts] or [0])
+
+
+class FirstFrameDetector(MotionDetector):
+    """
+    Compares every frame of a motion window with the first frame of that window.
+    """
+
+    def __init__(self, mask=None, scale=1.0):
+        super().__init__(mask, scale)
+        self.reference = None
+        self.matcher = HistogramMatcher()
+        self.full_reference = None
+        self.full_matcher = None
+
+    def start_window(self):
+        self.reset()
+
+    def reset(self):
+        self.reference = None
+        self.full_reference = None
+        self.full_matcher = None
+
+    def foreground(self, gray):
+        if self.reference is None:
+            self.reference = gray
+            self.full_reference = self.gray
+            self.matcher.set_reference(gray)
+            # Nothing moves against itself
+            return None
+        diff = ImageOperations.error_image_gray_histmatch(self.reference, gray, matcher=self.matcher)
+        return ImageOperations.convert_to_binary(diff)
+
+    def refine(self):
+        if self.full_matcher is None:
+            self.full_matcher = HistogramMatcher(self.full_reference)
+        diff = ImageOperations.error_image_gray_histmatch(self.full_reference, self.gray, matcher=self.full_matcher)
+        return self.max_contour(ImageOperations.convert_to_binary(diff), self.mask)
+
+
+class RunningAverageDetector(MotionDetector):
+    """
+    Keeps an exponentially weighted average of the scene as background.
+    Pixels that are moving are blended in at foreground_alpha, a tenth of
+    alpha by default, so lasting scene changes are absorbed over time.
+    """
+
+    def __init__(self, mask=None, scale=1.0, alpha=0.05, thresh=25, foreground_alpha=None):
+        super().__init__(mask, scale)
+        self.alpha = alpha
+        self.foreground_alpha = alpha / 10 if foreground_alpha is None else foreground_alpha
+        self.thresh = thresh
+        self.background = None
+
+    def reset(self):
+        self.background = None
+
+    def foreground(self, gray):
+        if self.background is None:
+            self.background = gray.astype(np.float32)
+            return None
+        diff = cv2.absdiff(gray, cv2.convertScaleAbs(self.background))
+        diff = ImageOperations.convert_to_binary(diff, self.thresh)
+        cv2.accumulateWeighted(gray, self.background, self.alpha, mask=cv2.bitwise_not(diff))
+        cv2.accumulateWeighted(gray, self.background, self.foreground_alpha, mask=diff)
+        return diff
+
+    def refine(self):
+        if self.background is None:
+            return None
+        height, width = self.gray.shape
+        background = cv2.resize(cv2.convertScaleAbs(self.background), (width, height), interpolation=cv2.INTER_LINEAR)
+        diff = ImageOperations.convert_to_binary(cv2.absdiff(self.gray, background), self.thresh)
+        return self.max_contour(diff, self.mask)
+
+
+class MOGDetector(MotionDetector):
+    """
+    Gaussian mixture background model (cv2 MOG2), updated on every frame.
+    Only the downscaled model is kept, so it can't refine.
+    """
+
+    def __init__(self, mask=None, scale=1.0, history=500, var_threshold=16, warmup=5):
+        super().__init__(mask, scale)
+        self.history = history
+        self.var_threshold = var_threshold
+        self.warmup = warmup
+        self.reset()
+
+    def reset(self):
+        self.subtractor = cv2.createBackgroundSubtractorMOG2(history=self.history,
+                                                             varThreshold=self.var_threshold,
+                                                             detectShadows=False)
+        self.frames_seen = 0
+
+    def foreground(self, gray):
+        diff = self.subtractor.apply(gray)
+        self.frames_seen += 1
+        if self.frames_seen <= self.warmup:
+            return None
+        return diff
+
+
+DETECTORS = {
+    'first_frame': FirstFrameDetector,
+    'running_average': RunningAverageDetector,
+    'mog': MOGDetector,
+}
+
+
+def create_detector(name, mask=None, scale=1.0):
+    if name not in DETECTORS:
+        logging.warning(f'Unknown detector {name}, using first_frame')
+        name = 'first_frame'
+    return DETECTORS[name](mask=mask, scale=scale)
+
+
+class DuplicateFilter:
+    """
+    Spots frames of an event that are nearly identical to the last frame
+    kept for it. Frames are compared as 32x18 gray thumbnails, area averaging
+    evens out sensor noise while an animal still shifts the cells it covers.
+    A frame is a duplicate when no cell changed by more than threshold gray
+    levels, at most max_skip duplicates in a row are dropped.
+    """
+    SIZE = (32, 18)
+
+    def __init__(self):
+        self.event_id = None
+        self.signature = None
+        self.skipped = 0
+        self.in_a_row = 0
+
+    @staticmethod
+    def thumbnail(frame):
+        return cv2.resize(ImageOperations.convert_image_to_gray(frame), DuplicateFilter.SIZE,
+                          interpolation=cv2.INTER_AREA)
+
+    def start(self, event_id):
+        """
+        :return: number of frames skipped in the previous event
+        """
+        skipped = self.skipped
+        self.event_id = event_id
+        self.signature = None
+        self.skipped = self.in_a_row = 0
+        return skipped
+
+    def is_duplicate(self, event_id, frame, threshold, max_skip):
+        if event_id != self.event_id:
+            self.start(event_id)
+
+        signature = self.thumbnail(frame)
+        if self.signature is not None and self.signature.shape == signature.shape and \
+                self.in_a_row < max_skip and cv2.absdiff(self.signature, signature).max() <= threshold:
+            self.skipped += 1
+            self.in_a_row += 1
+            return True
+
+        self.signature = signature
+        self.in_a_row = 0
+        return False
+
+
+class AdaptiveThreshold:
+    """
+    Exponentially weighted mean and variance of the contour areas seen in
+    windows without motion, kept per lighting regime ('day', 'night').
+    The threshold is mean + k standard deviations, held between floor and
+    ceiling, and stays at floor until warmup areas have been seen.
+    """
+
+    def __init__(self, warmup=20):
+        self.warmup = warmup
+        self.regimes = {}
+
+    def update(self, regime, areas, alpha):
+        stats = self.regimes.setdefault(regime, [0, 0.0, 0.0])
+        for area in areas:
+            count, mean, variance = stats
+            if count == 0:
+                mean, variance = area, 0.0
+            else:
+                diff = area - mean
+                mean += alpha * diff
+                variance = (1 - alpha) * (variance + alpha * diff * diff)
+            stats[:] = count + 1, mean, variance
+
+    def threshold(self, regime, floor, ceiling, k):
+        count, mean, variance = self.regimes.get(regime, (0, 0.0, 0.0))
+        if count < self.warmup:
+            return floor
+        return min(max(mean + k * math.sqrt(variance), floor), ceiling)
+
+
+class WorkSignal:
+    """
+    Wakes up a process blocked in wait() from another process, through a
+    named pipe in data_dir. notify() never blocks and is dropped when nobody
+    is waiting, so wait() should still be given a timeout.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.read_fd = None
+        self.write_fd = None
+        try:
+            os.mkfifo(path)
+        except FileExistsError:
+            pass
+
+    def notify(self):
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError:
+            return
+        try:
+            os.write(fd, b'1')
+        except BlockingIOError:
+            pass
+        finally:
+            os.close(fd)
+
+    def wait(self, timeout):
+        if self.read_fd is None:
+            self.read_fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+            # Holding a write end ourselves keeps the pipe from reporting EOF
+            # after every notify()
+            self.write_fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+
+        ready, _, _ = select.select([self.read_fd], [], [], timeout)
+        if ready:
+            os.read(self.read_fd, 4096)
+        return bool(ready)
+
+
+class Scheduler:
+    """
+    Deadline based timers for the periodic jobs of a daemon.
+    Jobs run from run_pending() in the caller's thread, wait() sleeps until
+    the next deadline, a timeout or the given signal, a WorkSignal or a
+    threading.Event.
+    Intervals are seconds, or callables returning seconds so they follow ME.json.
+    """
+
+    def __init__(self):
+        self.jobs = []
+
+    @staticmethod
+    def seconds(interval):
+        return interval() if callable(interval) else interval
+
+    def every(self, interval, callback, start_now=False):
+        deadline = time.monotonic() + (0 if start_now else self.seconds(interval))
+        self.jobs.append([deadline, interval, callback])
+
+    def run_pending(self):
+        for job in self.jobs:
+            if job[0] <= time.monotonic():
+                job[2]()
+                job[0] = time.monotonic() + self.seconds(job[1])
+
+    def time_to_next(self):
+        if not self.jobs:
+            return None
+        return max(0, min(job[0] for job in self.jobs) - time.monotonic())
+
+    def wait(self, signal=None, timeout=None):
+        """
+        :return: True if woken up by the signal
+        """
+        delay = self.time_to_next()
+        if timeout is not None:
+            delay = timeout if delay is None else min(delay, timeout)
+
+        if signal is not None:
+            return signal.wait(delay)
+        if delay is None:
+            raise ValueError('Nothing to wait for')
+        time.sleep(delay)
+        return False
+
+
+class Clock:
+    """
+    Time as seen by the scripts, replaced by a virtual clock when footage
+    is replayed.
+    """
+
+    def time(self):
+        return time.time()
+
+    def millis(self):
+        return round(self.time() * 1000)
+
+    def now(self):
+        return datetime.fromtimestamp(self.time())
+
+
 def get_disk_usage():
     disk = psutil.disk_usage('/')
     # print (obj_Disk.total / (1024.0 ** 3))
@@ -248,76 +716,281 @@ def get_disk_usage():
     return round(disk.free / (1024.0 ** 3), 3)
 
 
+REQUIRED = object()
+
+
+def as_time(value):
+    return dt_parse(str(value))
+
+
+class Config:
+    """
+    ME.json parsed and validated once per load.
+    FIELDS maps each attribute to its key, its default (REQUIRED if the key
+    must be present) and the conversion applied on load. A missing key or a
+    value that doesn't convert raises ValueError and the load is rejected.
+    """
+    FIELDS = (
+        ('name', 'description', REQUIRED, lambda v: str(v)[:24]),
+        ('video_interval', 'video_interval', REQUIRED, int),
+        ('motion_interval', 'motion_interval', REQUIRED, int),
+        ('rest_interval', 'rest_interval', REQUIRED, float),
+        ('day_threshold', 'day_threshold', REQUIRED, float),
+        ('night_threshold', 'night_threshold', REQUIRED, float),
+        ('sunset', 'sunset', REQUIRED, as_time),
+        ('sunrise', 'sunrise', REQUIRED, as_time),
+        ('update_after', 'update_after', REQUIRED, float),
+        ('last_reported_at', 'last_reported_at', REQUIRED, as_time),
+        ('frames_per_sec', 'frames_per_sec', REQUIRED, int),
+        ('pwm', 'pwm', REQUIRED, float),
+        ('motion1', 'motion_1', REQUIRED, int),
+        ('motion2', 'motion_2', REQUIRED, int),
+        ('infrared', 'infrared', REQUIRED, int),
+        ('filter_a', 'filter_a', REQUIRED, int),
+        ('filter_b', 'filter_b', REQUIRED, int),
+        ('live', 'live', REQUIRED, bool),
+        ('should_log', 'should_log', REQUIRED, bool),
+        ('roi_mask', 'roi_mask', None, None),
+        ('pre_roll', 'pre_roll', 0, int),
+        ('writer_workers', 'writer_workers', 2, int),
+        ('event_format', 'event_format', 'jpeg', str),
+        ('upload_workers', 'upload_workers', 1, int),
+        ('upload_timeout', 'upload_timeout', 30, float),
+        ('upload_budget', 'upload_budget', 0, float),
+        ('log_page_size', 'log_page_size', 500, int),
+        ('compress_logs', 'compress_logs', True, bool),
+        ('detector_type', 'detector', 'first_frame', str),
+        ('pyramid_scale', 'pyramid_scale', 1.0, float),
+        ('pyramid_margin', 'pyramid_margin', 0.5, float),
+        ('adaptive_threshold', 'adaptive_threshold', False, bool),
+        ('threshold_deviations', 'threshold_deviations', 3, float),
+        ('threshold_alpha', 'threshold_alpha', 0.05, float),
+        ('threshold_ceiling', 'threshold_ceiling', 4, float),
+        ('done_quota_mb', 'done_quota_mb', 0, float),
+        ('events_quota_mb', 'events_quota_mb', 0, float),
+        ('min_free_mb', 'min_free_mb', 512, float),
+        ('dedup', 'dedup', False, bool),
+        ('dedup_threshold', 'dedup_threshold', 12, float),
+        ('dedup_max_skip', 'dedup_max_skip', 4, int),
+        ('trigger_mode', 'trigger_mode', 'continuous', str),
+        ('pir_hold', 'pir_hold', 10, float),
+    )
+    __slots__ = tuple(field[0] for field in FIELDS) + ('raw', 'sunrise_time', 'sunset_time',
+                                                        'daylight', 'daylight_from', 'daylight_until')
+
+    def __init__(self, raw):
+        self.raw = raw
+        for attr, key, default, convert in self.FIELDS:
+            if key not in raw or raw[key] is None:
+                if default is REQUIRED:
+                    raise ValueError(f'ME.json is missing {key}')
+                value = default
+            else:
+                try:
+                    value = raw[key] if convert is None else convert(raw[key])
+                except (TypeError, ValueError):
+                    raise ValueError(f'ME.json has an invalid {key}: {raw[key]!r}')
+            setattr(self, attr, value)
+
+        self.sunrise_time = self.sunrise.time()
+        self.sunset_time = self.sunset.time()
+        self.daylight = None
+        self.daylight_from = self.daylight_until = 0
+
+    def is_sunlight(self, dt=None, now=None):
+        """
+        Day or night at dt. Without dt the answer for now, a unix timestamp
+        defaulting to the current time, is cached until the next sunrise or sunset.
+        """
+        if dt is not None:
+            return self.sunrise_time < dt.time() < self.sunset_time
+
+        now = time.time() if now is None else now
+        if not self.daylight_from <= now < self.daylight_until:
+            dt = datetime.fromtimestamp(now)
+            self.daylight = self.sunrise_time < dt.time() < self.sunset_time
+            boundaries = [datetime.combine(dt.date() + timedelta(days=days), at)
+                          for days in (0, 1) for at in (self.sunrise_time, self.sunset_time)]
+            self.daylight_from = now
+            self.daylight_until = min(b for b in boundaries if b > dt).timestamp()
+        return self.daylight
+
+
 class JSON:
-    ME = None
+    config = None
+
+    @property
+    def ME(self):
+        return None if self.config is None else self.config.raw
+
+    @ME.setter
+    def ME(self, value):
+        # Parsed and validated once here, the properties below only read attributes
+        self.config = Config(value)
 
     @property
     def name(self):
-        return self.ME['description'][:24]
+        return self.config.name
 
     @property
     def video_interval(self):
-        return self.ME['video_interval']
+        return self.config.video_interval
 
     @property
     def motion_interval(self):
-        return self.ME['motion_interval']
+        return self.config.motion_interval
 
-    @ property
+    @property
     def rest_interval(self):
-        return self.ME['rest_interval']
+        return self.config.rest_interval
 
     @property
     def day_threshold(self):
-        return self.ME['day_threshold']
+        return self.config.day_threshold
 
     @property
     def sunset(self):
-        return dt_parse(str(self.ME['sunset']))
+        return self.config.sunset
 
     @property
     def sunrise(self):
-        return dt_parse(str(self.ME['sunrise']))
+        return self.config.sunrise
 
     @property
     def night_threshold(self):
-        return self.ME['night_threshold']
+        return self.config.night_threshold
 
     @property
     def update_after(self):
-        return self.ME['update_after']
+        return self.config.update_after
 
     @property
     def last_reported_at(self):
-        return dt_parse(str(self.ME['last_reported_at']))
+        return self.config.last_reported_at
 
     @property
     def frames_per_sec(self):
-        return self.ME['frames_per_sec']
+        return self.config.frames_per_sec
 
     @property
     def pwm(self):
-        return self.ME['pwm']
+        return self.config.pwm
 
     @property
     def motion2(self):
-        return self.ME['motion_2']
+        return self.config.motion2
 
     @property
     def motion1(self):
-        return self.ME['motion_1']
+        return self.config.motion1
 
     @property
     def infrared(self):
-        return self.ME['infrared']
+        return self.config.infrared
 
     @property
     def filter_a(self):
-        return self.ME['filter_a']
+        return self.config.filter_a
 
     @property
     def filter_b(self):
-        return self.ME['filter_b']
+        return self.config.filter_b
+
+    @property
+    def pre_roll(self):
+        return self.config.pre_roll
+
+    @property
+    def writer_workers(self):
+        return self.config.writer_workers
+
+    @property
+    def event_format(self):
+        return self.config.event_format
+
+    @property
+    def upload_workers(self):
+        return self.config.upload_workers
+
+    @property
+    def upload_timeout(self):
+        return self.config.upload_timeout
+
+    @property
+    def upload_budget(self):
+        return self.config.upload_budget
+
+    @property
+    def log_page_size(self):
+        return self.config.log_page_size
+
+    @property
+    def compress_logs(self):
+        return self.config.compress_logs
+
+    @property
+    def detector_type(self):
+        return self.config.detector_type
+
+    @property
+    def pyramid_scale(self):
+        return self.config.pyramid_scale
+
+    @property
+    def pyramid_margin(self):
+        return self.config.pyramid_margin
+
+    @property
+    def adaptive_threshold(self):
+        return self.config.adaptive_threshold
+
+    @property
+    def threshold_deviations(self):
+        return self.config.threshold_deviations
+
+    @property
+    def threshold_alpha(self):
+        return self.config.threshold_alpha
+
+    @property
+    def threshold_ceiling(self):
+        return self.config.threshold_ceiling
+
+    @property
+    def done_quota_mb(self):
+        return self.config.done_quota_mb
+
+    @property
+    def events_quota_mb(self):
+        return self.config.events_quota_mb
+
+    @property
+    def min_free_mb(self):
+        return self.config.min_free_mb
+
+    @property
+    def dedup(self):
+        return self.config.dedup
+
+    @property
+    def dedup_threshold(self):
+        return self.config.dedup_threshold
+
+    @property
+    def dedup_max_skip(self):
+        return self.config.dedup_max_skip
+
+    @property
+    def trigger_mode(self):
+        return self.config.trigger_mode
+
+    @property
+    def pir_hold(self):
+        return self.config.pir_hold
+
+    @property
+    def roi_mask(self):
+        return self.config.roi_mask
 
 
 class Constants(JSON):
@@ -328,6 +1001,15 @@ class Constants(JSON):
     temp_dir = data_dir + '/temp/'
     false_dir = data_dir + '/false/'
     done_dir = data_dir + '/done/'
+    upload_fifo = data_dir + '/upload.fifo'
+    params_path = data_dir + '/ME.json'
+    params_stamp = None
+    params_check = 5
+    metrics_dir = data_dir + '/metrics/'
+    metrics_name = None
+    metrics_interval = 30
+    storage_interval = 30
+    clock = Clock()
     me_url = os.environ['SITE'] + '/core/api/camera/me/'
     logs_url = os.environ['SITE'] + '/core/api/logs/'
     image_url = os.environ['SITE'] + '/core/api/image/'
@@ -342,6 +1024,16 @@ class Constants(JSON):
 
     def __init__(self):
         self.db = SQLite("local.db", 5)
+        self.log_writer = BufferedWriter(self.db)
+        self.scheduler = Scheduler()
+        # A stat() every few seconds, ME.json is only parsed again when it changed
+        self.scheduler.every(self.params_check, self.read_params)
+
+        # Kept in memory by every script, only written out for the ones that set metrics_name
+        self.metrics = Metrics(None if self.metrics_name is None else self.metrics_dir + self.metrics_name + '.json')
+        self.db.on_lock_wait = lambda seconds: self.metrics.observe('sqlite_lock_wait_ms', seconds * 1000)
+        if self.metrics_name is not None:
+            self.scheduler.every(self.metrics_interval, self.flush_metrics)
 
         if not os.path.exists(self.data_dir):
             os.makedirs(self.data_dir)
@@ -352,36 +1044,62 @@ class Constants(JSON):
         if not os.path.exists(self.done_dir):
             os.makedirs(self.done_dir)
 
-        self.logging = True
-
     @property
     def live(self):
-        return self.ME['live']
+        return self.config.live
 
     @property
     def should_log(self):
-        return self.ME['should_log']
-
-    @property
-    def params_expired(self):
-        rn = datetime.now()
-        future = self.last_reported_at + timedelta(seconds=self.update_after)
-        return rn > future
+        return self.config.should_log
 
-    def put_log(self, values):
+    def put_log(self, log_type, message):
         if self.should_log:
-            with self.db:
-                self.db.data_entry(self.table, values)
+            self.log_writer.add(self.table, (datetime.now().strftime("%Y-%m-%dT%H:%M:%S"), log_type, 1, message))
+
+    def is_sunlight(self, dt=None):
+        return self.config.is_sunlight(dt, now=self.clock.time())
+
+    def flush_metrics(self):
+        self.metrics.flush()
+
+    def enforce_storage(self):
+        """
+        Applies the storage quotas of ME.json through self.storage.
+        :return: the storage pressure, see StorageManager.enforce
+        """
+        mb = self.storage.MB
+        state = self.storage.enforce(self.done_quota_mb * mb, self.events_quota_mb * mb, self.min_free_mb * mb)
+        self.metrics.gauge('events_mb', round(self.storage.size('events') / mb, 1))
+        self.metrics.gauge('done_mb', round(self.storage.size('done') / mb, 1))
+        return state
 
     def read_params(self):
+        """
+        Loads ME.json if it changed since the last load. The Monitor replaces
+        the file atomically, so a new inode or mtime means a complete new file.
+        """
         try:
-            with open(self.data_dir + '/ME.json', 'r') as file:
+            stat = os.stat(self.params_path)
+            stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if stamp == self.params_stamp and self.config is not None:
+                return
+
+            with open(self.params_path, 'r') as file:
                 self.ME = json.loads(file.read())
+            self.params_stamp = stamp
             logging.debug("ME.json loaded.")
         except IOError as e:
             logging.debug("Couldn't find/open ME.json file.")
+        except ValueError as e:
+            # Keeps running on the last good params
+            logging.error(f'Invalid ME.json: {e}')
+
+    def write_params(self, me):
+        temp_path = self.params_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            file.write(json.dumps(me, indent=4))
+        os.replace(temp_path, self.params_path)
 
 
-def format_logs(clogs, ulogs):
-    logs = [{"activity": c[1], "script": 'CAPTURE', "message": c[3], "logged_at": c[0]} for c in clogs]
-    return logs + [{"activity": u[1], "script": 'UPLOAD', "message": u[3], "logged_at": u[0]} for u in ulogs]
+def format_logs(rows, script):
+    return [{"activity": r[2], "script": script, "message": r[4], "logged_at": r[1]} for r in rows]
@@ -0,0 +1,107 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+import cv2
+
+from container import EventContainer
+
+
+class EventWriter:
+    """
+    Encodes and writes event frames on a pool of worker threads.
+    write() blocks while the queue is full, so a slow disk slows the capture
+    loop down instead of piling frames up in RAM.
+    Frames are encoded into temp_dir and renamed into the event directory, the
+    uploader never sees a half written jpg. With container set, frames are
+    appended to one EventContainer file per event instead.
+    on_saved(event, filename, created) is called once a frame is on disk,
+    event being the name of the event's entry in events_dir.
+    on_error(event_id, filename, error) is called when a frame can't be
+    written, e.g. the disk is full, the frame is lost.
+    With metrics given, encode and write time per frame is observed as frame_write_ms.
+    """
+
+    def __init__(self, events_dir, temp_dir, workers=2, queue_size=8, container=False, on_saved=None,
+                 on_error=None, metrics=None):
+        self.events_dir = events_dir
+        self.temp_dir = temp_dir
+        self.container = container
+        self.on_saved = on_saved
+        self.on_error = on_error
+        self.metrics = metrics
+        self.append_lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def write(self, event_id, filename, frame, created=None):
+        self.queue.put((event_id, filename, frame, created))
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                self.save(*item)
+            except Exception:
+                logging.exception('Error while writing event frame')
+            finally:
+                self.queue.task_done()
+
+    def save(self, event_id, filename, frame, created):
+        start = time.perf_counter()
+        ret_val, buffer = cv2.imencode('.jpg', frame)
+        if not ret_val:
+            logging.error(f'Could not encode frame {filename} of {event_id}')
+            return
+
+        try:
+            event = self.store(event_id, filename, buffer)
+        except OSError as e:
+            logging.error(f'Could not write frame {filename} of {event_id}: {e}')
+            if self.on_error is not None:
+                self.on_error(event_id, filename, e)
+            return
+
+        if self.metrics is not None:
+            self.metrics.observe('frame_write_ms', (time.perf_counter() - start) * 1000)
+        if self.on_saved is not None:
+            self.on_saved(event, filename, created)
+
+    def store(self, event_id, filename, buffer):
+        """
+        :return: name of the event's entry in events_dir
+        """
+        if self.container:
+            event = event_id + EventContainer.EXTENSION
+            with self.append_lock:
+                EventContainer.append(os.path.join(self.events_dir, event), int(filename[:-4]), buffer)
+            return event
+
+        event_path = os.path.join(self.events_dir, event_id)
+        os.makedirs(event_path, exist_ok=True)
+        temp_path = os.path.join(self.temp_dir, event_id + '_' + filename)
+        try:
+            with open(temp_path, 'wb') as file:
+                file.write(buffer)
+            os.replace(temp_path, os.path.join(event_path, filename))
+        except OSError:
+            # Don't leave a partial frame behind on a full disk
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return event_id
+
+    def flush(self):
+        self.queue.join()
+
+    def close(self):
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()